@@ -1,27 +1,67 @@
 """
 Main Application File
 """
-import io
 import sys
 import time
 import os
-import sqlite3
-from dataclasses import dataclass
 import math
 
-import folium
-import pandas as pd
 from PySide2 import QtWidgets, QtWebEngineWidgets, QtCore
-from PySide2.QtCore import QUrl
-from shapely.geometry import shape
-import geojson
-import geojsoncontour
-import numpy
-import branca
-from scipy.interpolate import griddata
-import matplotlib.pyplot as plt
-import scipy as sp
-from diagramcreator import save_diagram_file
+from PySide2.QtCore import QUrl, Signal, Slot, QRunnable, QThreadPool
+from PySide2.QtWebChannel import QWebChannel
+from diagramcreator import (
+    PLOTLY_JS_DIR,
+    radar_normalisation,
+    radar_page_html,
+    radar_update_script,
+    radar_values
+)
+from animation import ANIMATION_STEPS, FramePrefetcher, animation_requests
+from contour_cache import ContourCache
+from data_access import open_data_store
+from interpolation import GridInterpolator, GridResolutionPolicy
+from instrumentation import PipelineMetrics, ProfileCapture, StageTimer
+from land_mask import load_land_mask
+from mapcreator import (
+    MapRenderer,
+    UpdateCancelled,
+    UpdateRequest,
+    UpdateResult
+)
+from mappage import map_page_html, update_script
+from window_aggregation import AGGREGATIONS, WINDOW_HOURS, WindowAggregator
+
+# storage backend, "sqlite", "memory" (loads the whole database)
+# or the columnar "parquet" and "arrow" written by
+# database_builder.py --format
+DATA_BACKEND = os.environ.get("CONCEPTVA_BACKEND", "sqlite")
+DATA_PATH = os.environ.get("CONCEPTVA_DATA", "./data/data_test.db")
+# "linear" (Delaunay, like griddata), "idw" or "nearest" (KD-tree)
+INTERPOLATION_METHOD = os.environ.get("CONCEPTVA_INTERPOLATION", "linear")
+# contour grid cells along the longer side, the preview is used
+# while the salinity slider is dragged
+GRID_RESOLUTION = int(os.environ.get("CONCEPTVA_GRID_RESOLUTION", 500))
+PREVIEW_GRID_RESOLUTION = int(
+    os.environ.get("CONCEPTVA_PREVIEW_GRID_RESOLUTION", 120)
+)
+# meshes precomputed by contour_cache.py, used when the directory exists
+CONTOUR_CACHE_DIR = os.environ.get(
+    "CONCEPTVA_CONTOUR_CACHE", "./data/contour_cache"
+)
+# memory for the windows, meshes and layers of recently shown days
+RESULT_CACHE_MB = int(os.environ.get("CONCEPTVA_CACHE_MB", 512))
+# most points sent to the map page at once, above it the points
+# are aggregated per screen cell
+POINT_BUDGET = int(os.environ.get("CONCEPTVA_POINT_BUDGET", 2000000))
+# frames shown per second while playing and frames rendered ahead
+ANIMATION_FPS = float(os.environ.get("CONCEPTVA_ANIMATION_FPS", 4))
+ANIMATION_DEPTH = int(os.environ.get("CONCEPTVA_ANIMATION_DEPTH", 8))
+# the stage metrics of the session are written to this .json or .csv
+# file on exit, if set
+METRICS_PATH = os.environ.get("CONCEPTVA_METRICS")
+# "cprofile" or "tracemalloc" profiles every update into PROFILE_DIR
+PROFILE_MODE = os.environ.get("CONCEPTVA_PROFILE") or None
+PROFILE_DIR = os.environ.get("CONCEPTVA_PROFILE_DIR", "./profiles")
 
 start_coords = [54.12, 8.37]
 min_time = QtCore.QDateTime(QtCore.QDate(2013, 1, 1), QtCore.QTime(0, 0))
@@ -34,14 +74,6 @@ begin_start_time = QtCore.QDateTime(
     )
 
 
-@dataclass
-class MapData:
-    """ dataclass for the used point data """
-    data_obs: pd.DataFrame = pd.DataFrame()
-    data_bw: pd.DataFrame = pd.DataFrame()
-    data_fw: pd.DataFrame = pd.DataFrame()
-
-
 def datetime_to_timestring(date_time: QtCore.QDateTime):
     """ build a string compatible to the data
     we have from a QDateTime object """
@@ -76,17 +108,64 @@ def timestring_to_datetime(time_str: str):
     return date_time
 
 
-def create_salinity_df(md: MapData):
-    """ construct dataframe with salinity """
-    df = pd.concat(
-        (
-            md.data_obs[['latitude', 'longitude', 'sensor_1']],
-            md.data_bw[['latitude', 'longitude', 'sensor_1']],
-            md.data_fw[['latitude', 'longitude', 'sensor_1']],
-        )
-    )
+class MapBridge(QtCore.QObject):
+    """ the object the map page talks to through the QWebChannel """
+    zoomChanged = Signal(int)
+
+    @Slot(int)
+    def viewChanged(self, zoom: int):
+        """ called by the page after every zoom """
+        self.zoomChanged.emit(zoom)
+
+
+class UpdateSignals(QtCore.QObject):
+    """ a QRunnable is no QObject, its signals live here """
+    finished = Signal(object, object)
+    failed = Signal(str)
+    done = Signal()
+
+
+class UpdateWorker(QRunnable):
+    """
+    renders an update request off the GUI thread, it stops between
+    the stages as soon as a newer request superseded it
+    """
 
-    return df
+    def __init__(self, renderer: MapRenderer, request: UpdateRequest,
+                 generation: int, is_current,
+                 profile: ProfileCapture = None):
+        super().__init__()
+        # the view keeps the worker until it reported back
+        self.setAutoDelete(False)
+        self.renderer = renderer
+        self.profile = profile or ProfileCapture()
+        self.request = request
+        self.generation = generation
+        self.is_current = is_current
+        self.start_time = time.time()
+        self.signals = UpdateSignals()
+
+    def check_cancelled(self):
+        """ raise if a newer request is waiting """
+        if not self.is_current():
+            raise UpdateCancelled()
+
+    def run(self):
+        """ render the request and report back to the view """
+        timer = StageTimer()
+        try:
+            self.check_cancelled()
+            with self.profile.capture("update"):
+                result = self.renderer.render(
+                    self.request, timer, self.check_cancelled
+                )
+            self.signals.finished.emit(result, timer)
+        except UpdateCancelled:
+            pass
+        except Exception as error:
+            self.signals.failed.emit(repr(error))
+        finally:
+            self.signals.done.emit()
 
 
 class MapView(QtWidgets.QMainWindow):
@@ -95,6 +174,10 @@ class MapView(QtWidgets.QMainWindow):
         super().__init__()
         self.radarplot_webview = QtWebEngineWidgets.QWebEngineView()
         self.update_button = QtWidgets.QPushButton("Update")
+        self.play_button = QtWidgets.QPushButton("Play")
+        self.animation_step_combobox = QtWidgets.QComboBox()
+        self.window_combobox = QtWidgets.QComboBox()
+        self.aggregation_combobox = QtWidgets.QComboBox()
         self.next_day_button = QtWidgets.QPushButton(">")
         self.prev_day_button = QtWidgets.QPushButton("<")
         self.display_points_checkbox = QtWidgets.QCheckBox()
@@ -103,325 +186,370 @@ class MapView(QtWidgets.QMainWindow):
         self.salinity_spinbox = QtWidgets.QDoubleSpinBox()
         self.date_label = QtWidgets.QLabel()
         self.date_label.setFixedHeight(20)
-        self.fol_map = folium.Map(location=start_coords, zoom_start=10)
         self.map_webview = QtWebEngineWidgets.QWebEngineView()
-        self.map_webview.loadFinished.connect(lambda: self.update_finished())
+        self.map_webview.loadFinished.connect(lambda: self.map_loaded())
+        self.radarplot_webview.loadFinished.connect(
+            lambda: self.radar_loaded()
+        )
+        self.radar_ready = False
+        self.pending_radar_script = None
+        self.map_ready = False
+        self.pending_map_script = None
+        self.map_zoom = 10
+        self.points_reduced = False
+        self.map_bridge = MapBridge()
+        self.map_bridge.zoomChanged.connect(self.zoom_changed)
+        self.map_channel = QWebChannel()
+        self.map_channel.registerObject("bridge", self.map_bridge)
+        self.map_webview.page().setWebChannel(self.map_channel)
         self.start_datetime_edit = QtWidgets.QDateTimeEdit()
         self.slider = QtWidgets.QSlider(QtCore.Qt.Horizontal)
-        self.runtime_ds = MapData()
-        self.radarplot_url = QUrl.fromLocalFile(
-            os.path.join(os.path.abspath(
-                os.path.dirname(__file__)
-                ),
-                'radarplot.html')
-            )
+        self.interpolator = GridInterpolator(INTERPOLATION_METHOD)
+        self.grid_policy = GridResolutionPolicy(
+            full_resolution=GRID_RESOLUTION,
+            preview_resolution=PREVIEW_GRID_RESOLUTION
+        )
+        self.stage_timings = dict()
+        # updates are rendered one at a time off the GUI thread,
+        # a new request supersedes the queued and the running one
+        self.update_pool = QThreadPool()
+        self.update_pool.setMaxThreadCount(1)
+        self.update_generation = 0
+        self.update_workers = set()
+        self.latest_request = None
+        # a preview while the slider is dragged, full detail once it rests
+        self.preview_timer = QtCore.QTimer()
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(50)
+        self.preview_timer.timeout.connect(
+            lambda: self.update_map(preview=True)
+        )
+        self.refine_timer = QtCore.QTimer()
+        self.refine_timer.setSingleShot(True)
+        self.refine_timer.setInterval(400)
+        self.refine_timer.timeout.connect(lambda: self.update_map())
+        # playback shows the prefetched frames at a fixed rate
+        self.prefetcher = None
+        self.animation_timer = QtCore.QTimer()
+        self.animation_timer.setInterval(int(1000 / ANIMATION_FPS))
+        self.animation_timer.timeout.connect(lambda: self.animation_tick())
+        # stage statistics of all updates, the page loads and the startup
+        self.metrics = PipelineMetrics()
+        self.profile = ProfileCapture(PROFILE_MODE, PROFILE_DIR)
+        self.map_load_start = None
+        self.radar_load_start = None
 
         print("started loading...")
         start_time = time.time()
-        self.read_db()
-        self.read_polygon()
+        timer = StageTimer()
+        with timer.stage("read db"):
+            self.read_db()
+        with timer.stage("land mask"):
+            self.land_mask = load_land_mask()
+        contour_cache = None
+        if os.path.isdir(CONTOUR_CACHE_DIR):
+            contour_cache = ContourCache(
+                CONTOUR_CACHE_DIR, self.data_store,
+                self.interpolator, self.grid_policy
+            )
+        self.renderer = MapRenderer(
+            self.data_store, self.interpolator, self.grid_policy,
+            POINT_BUDGET, contour_cache, RESULT_CACHE_MB * 2**20,
+            self.land_mask, WindowAggregator(self.data_store)
+        )
+        self.metrics.add(timer)
         print("loading done in " + str(time.time() - start_time) + " seconds")
+        print("  " + timer.summary())
 
         self.setCentralWidget(self.create_gui())
 
     def read_db(self):
-        """ put all db data into a runtime data structure """
-        db = sqlite3.connect("./data/data_test.db")
-        query_obs = "SELECT * FROM OBS"
-        self.runtime_ds.data_obs = pd.read_sql_query(query_obs, db)
-        query_bw = "SELECT * FROM BW"
-        self.runtime_ds.data_bw = pd.read_sql_query(query_bw, db)
-        query_fw = "SELECT * FROM FW"
-        self.runtime_ds.data_fw = pd.read_sql_query(query_fw, db)
-        db.close()
-
-        all_sensor_names = [f"sensor_{i}" for i in range(1, 8)]
-
-        self.global_data = dict()
-        for sensor_name in all_sensor_names:
-            data_sensor = pd.concat([
-                self.runtime_ds.data_obs[sensor_name],
-                self.runtime_ds.data_bw[sensor_name],
-                self.runtime_ds.data_fw[sensor_name]
-                ])
-
-            sensor_min = data_sensor.min()
-            sensor_min = max(0, sensor_min)
-            sensor_max = data_sensor.max()
-            sensor_mean = data_sensor.mean()
-
-            self.global_data |= {
-                    sensor_name: {
-                        'max': sensor_max,
-                        'min': sensor_min,
-                        'mean': sensor_mean
-                    }
-                }
+        """ open the data store, only the precomputed statistics are read
+        here, the data itself is queried per time window """
+        self.data_store = open_data_store(DATA_BACKEND, DATA_PATH)
+        sensor_statistics = self.data_store.sensor_statistics()
+        self.global_data = radar_normalisation(sensor_statistics)
 
         # get min and max sal values
-        self.sal_max_global = math.ceil(
-            max(
-                self.runtime_ds.data_obs['sensor_1'].max(),
-                self.runtime_ds.data_bw['sensor_1'].max(),
-                self.runtime_ds.data_fw['sensor_1'].max())
-            )
-        self.sal_min_global = math.floor(
-            min(
-                self.runtime_ds.data_obs['sensor_1'].min(),
-                self.runtime_ds.data_bw['sensor_1'].min(),
-                self.runtime_ds.data_fw['sensor_1'].min())
-            )
-
-    def read_polygon(self):
-        """ read polygon data needed to construct visualizations """
-        with open("data/GermanyPolygon.json") as file:
-            geo_json_data = geojson.load(file)
-        self.ger_polygon = shape(geo_json_data)
-
-    def get_data_for_time_range(
-        self, start_datetime: QtCore.QDateTime,
-        end_datetime: QtCore.QDateTime
-    ):
-        """ returns an object (currently "struct" of dataframes)
-        which contains the data relevant for the given time """
-        start_time_str = datetime_to_timestring(start_datetime)
-        end_time_str = datetime_to_timestring(end_datetime)
-
-        m_data = MapData()
-
-        m_data.data_obs = self.runtime_ds.data_obs[
-            self.runtime_ds.data_obs["time"].between(
-                str.encode(start_time_str),
-                str.encode(end_time_str)
-                )
-                ]
-        m_data.data_bw = self.runtime_ds.data_bw[
-            self.runtime_ds.data_bw["initial_time"].between(
-                int(start_time_str),
-                int(end_time_str))
-            ]
-        m_data.data_fw = self.runtime_ds.data_fw[
-            self.runtime_ds.data_fw["initial_time"].between(
-                int(start_time_str),
-                int(end_time_str))
-            ]
-
-        return m_data
-
-    def update_map(self):
-        """ update map when new time was selected """
+        self.sal_max_global = math.ceil(sensor_statistics['sensor_1']['max'])
+        self.sal_min_global = math.floor(sensor_statistics['sensor_1']['min'])
+
+    def update_map(self, preview: bool = False):
+        """ update map when new time was selected,
+        a preview uses the coarse contour grid """
+        if self.prefetcher is not None:
+            self.stop_animation()
         print("started updating...")
-        start_time = time.time()
         # set label to updating
         self.date_label.setText("Updating...")
 
-        # deactivate UI
-        self.start_datetime_edit.setEnabled(False)
-        self.prev_day_button.setEnabled(False)
-        self.next_day_button.setEnabled(False)
-        self.update_button.setEnabled(False)
-
-        QtCore.QCoreApplication.processEvents()
-
         start_datetime = self.start_datetime_edit.dateTime()
-        end_datetime = self.start_datetime_edit.dateTime().addDays(1)
+        end_datetime = start_datetime.addSecs(3600 * self.window_hours())
+        request = UpdateRequest(
+            start_key=int(datetime_to_timestring(start_datetime)),
+            end_key=int(datetime_to_timestring(end_datetime)),
+            sal_val=self.salinity_spinbox.value(),
+            smoothing=self.gaussfilter_spinbox.value(),
+            show_points=self.display_points_checkbox.isChecked(),
+            preview=preview,
+            zoom=self.map_zoom,
+            aggregation=self.aggregation_combobox.currentText()
+        )
+        self.latest_request = request
+
+        # the queued request is dropped, the running one stops
+        # at its next stage
+        self.update_generation += 1
+        generation = self.update_generation
+        for queued in list(self.update_workers):
+            if self.update_pool.tryTake(queued):
+                self.update_workers.discard(queued)
+
+        worker = UpdateWorker(
+            self.renderer, request, generation,
+            lambda: generation == self.update_generation, self.profile
+        )
+        worker.signals.finished.connect(
+            lambda result, timer: self.update_rendered(worker, result, timer)
+        )
+        worker.signals.failed.connect(
+            lambda error: self.update_failed(worker, error)
+        )
+        worker.signals.done.connect(
+            lambda: self.update_workers.discard(worker)
+        )
+        self.update_workers.add(worker)
+        self.update_pool.start(worker)
 
-        sal_val = self.salinity_spinbox.value()
+        step = 3600 * self.step_hours()
+        self.prev_day_button.setEnabled(
+            start_datetime.addSecs(-step) >= min_time
+        )
+        self.next_day_button.setEnabled(
+            start_datetime.addSecs(step) <= max_time
+        )
 
-        # get data
-        m_data = self.get_data_for_time_range(start_datetime, end_datetime)
+    def window_hours(self):
+        """ length of the selected window """
+        return WINDOW_HOURS[self.window_combobox.currentText()]
 
-        save_diagram_file(
-            m_data,
-            self.global_data,
-            sal_val
-            )
-        self.radarplot_webview.load(self.radarplot_url)
+    def step_hours(self):
+        """ the arrows move by the window, at most by a day """
+        return min(self.window_hours(), 24)
 
-        # rebuild map
-        self.fol_map = folium.Map(location=start_coords, zoom_start=10)
+    def step_window(self, direction: int):
+        """ move the window back (-1) or forward (1) """
+        self.start_datetime_edit.setDateTime(
+            self.start_datetime_edit.dateTime().addSecs(
+                direction * 3600 * self.step_hours()
+            )
+        )
 
-        # draw contour map or circles
-        if self.display_points_checkbox.isChecked():
-            self.draw_points(m_data, sal_val)
-        else:
-            self.draw_contour_map(m_data, sal_val)
-
-        # convert map to bytes and set html to webview
-        data = io.BytesIO()
-        self.fol_map.location = start_coords
-        self.fol_map.save(data, close_file=False)
-        html = data.getvalue().decode()
-        self.map_webview.setHtml(html)
-        self.map_webview.setVisible(True)
-
-        # reactivate UI
-        self.start_datetime_edit.setEnabled(True)
-        self.prev_day_button.setEnabled(start_datetime.addDays(-1) >= min_time)
-        self.next_day_button.setEnabled(start_datetime.addDays(1) <= max_time)
-        self.update_button.setEnabled(True)
-
-        print("updating done in " + str(time.time() - start_time) + " seconds")
-
-    def draw_circle_markers(self, df: pd.DataFrame, color: str):
-        """
-        add a marker for each measurement in the given color
-        If to many markers are created (around >5000), view will not render
-        """
-        for _, row in df.iterrows():
-            coords = [row['latitude'], row['longitude']]
-            folium.vector_layers.Circle(
-                location=coords, radius=5, color=color,
-                fill=True, fillOpacity=1.0, fillColor=color
-            ).add_to(self.fol_map)
-
-    def draw_points(self, md: MapData, sal_val: float):
-        """ draw the points on the map """
-        df = create_salinity_df(md)
-        if df.empty:
+    def update_rendered(
+        self, worker: UpdateWorker, result: UpdateResult, timer: StageTimer
+    ):
+        """ show a rendered update unless a newer one was requested """
+        if worker.generation != self.update_generation:
+            self.metrics.count("updates superseded")
             return
 
-        # color stuff for the map
-        sal_min = df['sensor_1'].min()
-        sal_max = df['sensor_1'].max()
-        # make sure salinity is between min and max
-        if sal_val < sal_min:
-            levels = [sal_min, sal_min + 0.3 * (sal_max - sal_min), sal_max]
-            colors = ['#77b5d4', '#06618f']
-        elif sal_val > sal_max:
-            levels = [sal_min, sal_min + 0.7 * (sal_max - sal_min), sal_max]
-            colors = ['#b5212f', '#de7881']
-        else:
-            levels = [
-                sal_min,
-                sal_min + 0.7 * (sal_val - sal_min),
-                sal_val,
-                sal_val + 0.3 * (sal_max - sal_val),
-                sal_max
-                ]
-            colors = ['#b5212f', '#de7881', '#77b5d4', '#06618f']
-
-        # scale values for colors
-        col_map = branca.colormap.StepColormap(
-            colors, vmin=sal_min, vmax=sal_max, index=levels
+        self.show_result(result, timer)
+        self.metrics.add(timer)
+        self.metrics.count("updates")
+        cache_summary = self.renderer.result_cache.summary()
+        self.statusBar().showMessage(timer.summary() + " | " + cache_summary)
+        print(
+            "updating done in " + str(time.time() - worker.start_time)
+            + " seconds"
         )
-        col_map.caption = "Salinity in PSU"
-
-        # reduce dataframe size
-        df = self.reduce_dataframe_size(df)
-
-        for i, color in enumerate(colors):
-            points = df[df['sensor_1'].between(levels[i], levels[i + 1])]
-            self.draw_circle_markers(points, color)
-
-        # add legend
-        self.fol_map.add_child(col_map)
-
-    def reduce_dataframe_size(self, df: pd.DataFrame):
-        """
-        reduces the dataframe size below 2000.
-            # TODO: rework this, use for demo purposes only !!!
-        """
-        target_size = 2000
-        if len(df.index) < target_size:
-            return df
-        step_size = int(len(df.index) / target_size)
-        df = df.iloc[::step_size, :]
-
-        return df
-
-    def draw_contour_map(self, md: MapData, sal_val: float):
-        """ draw contour map """
-        df = create_salinity_df(md)
-        if df.empty:
-            return
+        print("  " + timer.summary())
+        print("  " + cache_summary)
+
+    def show_result(self, result: UpdateResult, timer: StageTimer):
+        """ send the layers and the radar values of a result to the pages """
+        self.points_reduced = result.points_reduced
+        self.latest_request = result.request
+
+        # the radar page is loaded once, only the r arrays are sent
+        with timer.stage("radar plot"):
+            self.run_radar_script(radar_update_script(
+                radar_values(result.radar, self.global_data)
+            ))
+
+        # only the new layers are sent to the already loaded map page
+        with timer.stage("map update"):
+            self.run_map_script(
+                update_script(**result.layers), result.request
+            )
+            self.map_webview.setVisible(True)
 
-        # color stuff for the map
-        sal_min = df['sensor_1'].min()
-        sal_max = df['sensor_1'].max()
-        # make sure salinity is between min and max
-        if sal_val < sal_min:
-            levels = [
-                sal_min,
-                sal_min + 0.3 * (sal_max - sal_min),
-                sal_max
-                ]
-            colors = ['#77b5d4', '#06618f']
-        elif sal_val > sal_max:
-            levels = [
-                sal_min,
-                sal_min + 0.7 * (sal_max - sal_min),
-                sal_max
-                ]
-            colors = ['#b5212f', '#de7881']
+        self.stage_timings = timer.timings
+
+    def toggle_animation(self):
+        """ play or pause """
+        if self.prefetcher is None:
+            self.start_animation()
         else:
-            levels = [
-                sal_min,
-                sal_min + 0.7 * (sal_val - sal_min),
-                sal_val,
-                sal_val + 0.3 * (sal_max - sal_val),
-                sal_max
-                ]
-            colors = ['#b5212f', '#de7881', '#77b5d4', '#06618f']
-
-        # scale values for colors
-        col_map = branca.colormap.StepColormap(
-            colors, vmin=sal_min, vmax=sal_max, index=levels
+            self.stop_animation()
+            self.update_map()
+
+    def start_animation(self):
+        """ play from the selected time to the end of the data,
+        the frames use the coarse grid to keep up with the rate """
+        # updates still rendering are superseded by the animation
+        self.update_generation += 1
+        for queued in list(self.update_workers):
+            if self.update_pool.tryTake(queued):
+                self.update_workers.discard(queued)
+
+        step_hours = ANIMATION_STEPS[
+            self.animation_step_combobox.currentText()
+        ]
+        template = UpdateRequest(
+            start_key=0,
+            end_key=0,
+            sal_val=self.salinity_spinbox.value(),
+            smoothing=self.gaussfilter_spinbox.value(),
+            show_points=self.display_points_checkbox.isChecked(),
+            preview=True,
+            zoom=self.map_zoom,
+            aggregation=self.aggregation_combobox.currentText()
         )
-        col_map.caption = "Salinity in PSU"
-
-        # data to lists
-        x_data = numpy.asarray(df.longitude.tolist())
-        y_data = numpy.asarray(df.latitude.tolist())
-        z_data = numpy.asarray(df.sensor_1.tolist())
+        self.prefetcher = FramePrefetcher(
+            self.renderer,
+            animation_requests(
+                int(datetime_to_timestring(
+                    self.start_datetime_edit.dateTime()
+                )),
+                int(datetime_to_timestring(max_time)),
+                step_hours,
+                template,
+                self.window_hours()
+            ),
+            depth=ANIMATION_DEPTH
+        )
+        self.play_button.setText("Pause")
+        self.animation_timer.start()
+
+    def stop_animation(self):
+        """ stop playing and the rendering of the frames ahead """
+        self.animation_timer.stop()
+        self.prefetcher.close()
+        print("animation stopped, " + self.prefetcher.summary())
+        self.prefetcher = None
+        self.play_button.setText("Play")
+
+    def animation_tick(self):
+        """ show the next frame if it is rendered, else it is dropped """
+        try:
+            frame = self.prefetcher.next_frame()
+        except Exception as error:
+            self.stop_animation()
+            self.statusBar().showMessage(repr(error))
+            return
+        if frame is None:
+            if self.prefetcher.finished():
+                self.stop_animation()
+            else:
+                self.metrics.count("frames dropped")
+                self.statusBar().showMessage(self.prefetcher.summary())
+            return
 
-        # build grid
-        x_lin = numpy.linspace(numpy.min(x_data), numpy.max(x_data), 500)
-        y_lin = numpy.linspace(numpy.min(y_data), numpy.max(y_data), 500)
-        x_mesh, y_mesh = numpy.meshgrid(x_lin, y_lin)
+        result, timer = frame
+        self.show_result(result, timer)
+        self.metrics.add(timer)
+        self.metrics.count("frames")
+        # move the selection along without starting an update
+        self.start_datetime_edit.blockSignals(True)
+        self.start_datetime_edit.setDateTime(
+            timestring_to_datetime(str(result.request.start_key))
+        )
+        self.start_datetime_edit.blockSignals(False)
+        self.statusBar().showMessage(
+            self.prefetcher.summary() + " | " + timer.summary()
+        )
 
-        # add sensor values to grid
-        z_mesh = griddata(
-            (x_data, y_data), z_data, (x_mesh, y_mesh), method='linear'
+    def update_failed(self, worker: UpdateWorker, error: str):
+        """ a worker raised, only the latest request is reported """
+        print("updating failed: " + error)
+        self.metrics.count("updates failed")
+        if worker.generation == self.update_generation:
+            self.date_label.setText("Update failed")
+            self.statusBar().showMessage(error)
+
+    def run_map_script(self, script: str, request: UpdateRequest):
+        """ send a layer update to the map page,
+        the latest one is kept until the page is loaded """
+        if not self.map_ready:
+            self.pending_map_script = (script, request)
+            return
+        start_time = time.perf_counter()
+        self.map_webview.page().runJavaScript(
+            script,
+            lambda _: self.map_script_done(len(script), start_time, request)
         )
 
-        # optional gaussian filter to smoothen contour map
-        if self.gaussfilter_spinbox.value() > 0:
-            gauss_strength = self.gaussfilter_spinbox.value()
-            sigma = [gauss_strength, gauss_strength]
-            z_mesh = sp.ndimage.filters.gaussian_filter(
-                z_mesh, sigma, mode='constant'
+    def run_radar_script(self, script: str):
+        """ send new values to the radar page,
+        the latest ones are kept until the page is loaded """
+        if not self.radar_ready:
+            self.pending_radar_script = script
+            return
+        self.radarplot_webview.page().runJavaScript(script)
+
+    def radar_loaded(self):
+        """ the radar page is loaded once, send the values waiting for it """
+        self.radar_ready = True
+        if self.radar_load_start is not None:
+            self.metrics.add_timing(
+                "radar page load", time.perf_counter() - self.radar_load_start
             )
-
-        contourf = plt.contourf(
-            x_mesh, y_mesh, z_mesh, levels,
-            alpha=0.5, colors=colors, linestyles='None',
-            vmin=sal_min, vmax=sal_max
+            self.radar_load_start = None
+        if self.pending_radar_script is not None:
+            script = self.pending_radar_script
+            self.pending_radar_script = None
+            self.run_radar_script(script)
+
+    def map_script_done(
+        self, payload_bytes: int, start_time: float, request: UpdateRequest
+    ):
+        """ the page replaced its layers, the latency and the size of
+        the script go into the session metrics """
+        self.metrics.add_timing(
+            "map layers replaced", time.perf_counter() - start_time
+        )
+        self.metrics.count("map updates")
+        self.metrics.count("map payload bytes", payload_bytes)
+        self.update_finished(request)
+
+    def map_loaded(self):
+        """ the map page is loaded once, send the update waiting for it """
+        self.map_ready = True
+        if self.map_load_start is not None:
+            self.metrics.add_timing(
+                "map page load", time.perf_counter() - self.map_load_start
             )
-
-        geo_json = geojsoncontour.contourf_to_geojson(
-            contourf=contourf,
-            min_angle_deg=3.0,
-            ndigits=5,
-            stroke_width=1,
-            fill_opacity=0.5)
-
-        folium.GeoJson(
-            geo_json,
-            style_function=lambda x: {
-                'color': x['properties']['stroke'],
-                'weight': x['properties']['stroke-width'],
-                'fillColor': x['properties']['fill'],
-                'opacity': 0.6,
-            }).add_to(self.fol_map)
-
-        # add legend
-        self.fol_map.add_child(col_map)
-
-    def update_finished(self):
-        """ update label """
-        start_date = self.start_datetime_edit.dateTime().toString()
-        start_date_p_one = self.start_datetime_edit.dateTime().addDays(1).toString()
+            self.map_load_start = None
+        if self.pending_map_script is not None:
+            script, request = self.pending_map_script
+            self.pending_map_script = None
+            self.run_map_script(script, request)
+
+    def zoom_changed(self, zoom: int):
+        """ aggregated points depend on the zoom level of the map """
+        self.map_zoom = zoom
+        if self.points_reduced and self.display_points_checkbox.isChecked():
+            self.refine_timer.start()
+
+    def update_finished(self, request: UpdateRequest):
+        """ update label to the window that is displayed """
+        if request is not self.latest_request:
+            # a newer request is still being rendered
+            return
+        start_date = timestring_to_datetime(str(request.start_key)).toString()
+        start_date_p_one = timestring_to_datetime(
+            str(request.end_key)
+        ).toString()
         self.date_label.setText(
             f"Currently displaying: {start_date} to {start_date_p_one}"
             )
@@ -435,27 +563,46 @@ class MapView(QtWidgets.QMainWindow):
         self.start_datetime_edit.setCalendarPopup(1)
         self.start_datetime_edit.setDateTime(begin_start_time)
         self.start_datetime_edit.setMinimumWidth(120)
-        self.start_datetime_edit.dateChanged.connect(lambda: self.update_map())
+        # windows shorter than a day start at any hour
+        self.start_datetime_edit.dateTimeChanged.connect(
+            lambda: self.update_map()
+        )
         self.prev_day_button.setFixedWidth(50)
-        self.prev_day_button.setToolTip("Previous Day")
-        self.prev_day_button.clicked.connect(
-            lambda: self.start_datetime_edit.setDateTime(
-                self.start_datetime_edit.dateTime().addDays(-1))
-            )
+        self.prev_day_button.setToolTip("Previous Window")
+        self.prev_day_button.clicked.connect(lambda: self.step_window(-1))
         self.next_day_button.setFixedWidth(50)
-        self.next_day_button.setToolTip("Next Day")
-        self.next_day_button.clicked.connect(
-            lambda: self.start_datetime_edit.setDateTime(
-                self.start_datetime_edit.dateTime().addDays(1))
-            )
+        self.next_day_button.setToolTip("Next Window")
+        self.next_day_button.clicked.connect(lambda: self.step_window(1))
+
+        # build window selection
+        self.window_combobox.addItems(list(WINDOW_HOURS))
+        self.window_combobox.setCurrentText("1 day")
+        self.window_combobox.setToolTip("Length of the analyzed window")
+        self.window_combobox.currentIndexChanged.connect(
+            lambda: self.update_map()
+        )
+        self.aggregation_combobox.addItems(AGGREGATIONS)
+        self.aggregation_combobox.setToolTip(
+            "Show the measurements (raw) or one value per grid cell "
+            "aggregated over the window"
+        )
+        self.aggregation_combobox.currentIndexChanged.connect(
+            lambda: self.update_map()
+        )
 
         # build button
         self.update_button.clicked.connect(lambda: self.update_map())
+        self.play_button.setToolTip(
+            "Play the data from the selected time on"
+        )
+        self.play_button.clicked.connect(lambda: self.toggle_animation())
+        self.animation_step_combobox.addItems(list(ANIMATION_STEPS))
+        self.animation_step_combobox.setToolTip("Time between two frames")
 
         # build labels
-        from_label = QtWidgets.QLabel(
-            "Analyze Data for 24 hours, starting from: "
-        )
+        for_label = QtWidgets.QLabel("Analyze Data for ")
+        for_label.setFixedHeight(20)
+        from_label = QtWidgets.QLabel(", starting from: ")
         from_label.setFixedHeight(20)
 
         # build slider stuff
@@ -471,6 +618,9 @@ class MapView(QtWidgets.QMainWindow):
             lambda: self.salinity_changed(0)
         )
         self.salinity_spinbox.setValue(25.0)
+        self.salinity_spinbox.valueChanged.connect(
+            lambda: self.threshold_changed()
+        )
 
         # build display settings
         self.gaussfilter_label.setFixedHeight(20)
@@ -498,16 +648,32 @@ class MapView(QtWidgets.QMainWindow):
 
         # build lower layout
         control_layout = QtWidgets.QHBoxLayout()
+        control_layout.addWidget(for_label)
+        control_layout.addWidget(self.window_combobox)
+        control_layout.addWidget(self.aggregation_combobox)
         control_layout.addWidget(from_label)
         control_layout.addWidget(self.prev_day_button)
         control_layout.addWidget(self.start_datetime_edit)
         control_layout.addWidget(self.next_day_button)
         control_layout.addStretch(1)
         control_layout.addWidget(self.update_button)
+        control_layout.addWidget(self.play_button)
+        control_layout.addWidget(self.animation_step_combobox)
         control_layout.addWidget(slider_current_label)
         control_layout.addWidget(self.salinity_spinbox)
         control_layout.addWidget(self.slider)
 
+        # the map page is loaded once, updates only replace its layers
+        self.map_load_start = time.perf_counter()
+        self.map_webview.setHtml(map_page_html(start_coords))
+
+        # the radar page as well, plotly.min.js is read from the package
+        self.radar_load_start = time.perf_counter()
+        self.radarplot_webview.setHtml(
+            radar_page_html(),
+            QUrl.fromLocalFile(PLOTLY_JS_DIR + os.sep)
+        )
+
         # build webview layout
         webview_layout = QtWidgets.QHBoxLayout()
         webview_layout.addWidget(self.map_webview)
@@ -534,6 +700,25 @@ class MapView(QtWidgets.QMainWindow):
             if self.salinity_spinbox.value != self.slider.value:
                 self.slider.setValue(self.salinity_spinbox.value() * 100.0)
 
+    def threshold_changed(self):
+        """ redraw with the coarse grid while the slider is dragged
+        and with the full grid once the salinity stops changing """
+        if self.slider.isSliderDown() and not self.preview_timer.isActive():
+            self.preview_timer.start()
+        self.refine_timer.start()
+
+    def closeEvent(self, event):
+        """ stop the running update before the window goes away """
+        if self.prefetcher is not None:
+            self.stop_animation()
+        self.update_generation += 1
+        self.update_pool.clear()
+        self.update_pool.waitForDone()
+        print("session metrics: " + self.metrics.summary())
+        if METRICS_PATH:
+            self.metrics.export(METRICS_PATH)
+        super().closeEvent(event)
+
     def show_points_slot(self):
         """ how to proceed if point slot changes """
         state = self.display_points_checkbox.isChecked() == 0
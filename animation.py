@@ -0,0 +1,107 @@
+"""
+Playback of the data hour by hour or day by day,
+the next frames are rendered in the background while one is shown
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from data_access import shift_key
+from instrumentation import StageTimer
+from mapcreator import MapRenderer, UpdateRequest
+
+# hours between two frames and the length of their windows
+ANIMATION_STEPS = {"hourly": 1, "daily": 24}
+
+
+def animation_requests(
+    start_key: int, last_key: int, step_hours: int, template: UpdateRequest,
+    window_hours: int = None
+):
+    """ the requests of the frames from start_key up to last_key,
+    every window is one step long unless window_hours is given,
+    the rest is taken from template """
+    window_hours = window_hours or step_hours
+    while start_key <= last_key:
+        yield UpdateRequest(
+            start_key, shift_key(start_key, hours=window_hours),
+            template.sal_val, template.smoothing, template.show_points,
+            template.preview, template.zoom, template.aggregation
+        )
+        start_key = shift_key(start_key, hours=step_hours)
+
+
+class FramePrefetcher:
+    """
+    keeps the next frames of a request generator rendering in a few
+    threads, the player takes them in order; a frame that is not ready
+    in time counts as dropped, the queue depth is the number of frames
+    finished ahead of the player
+    """
+
+    def __init__(self, renderer: MapRenderer, requests, depth: int = 4,
+                 workers: int = 2):
+        self.renderer = renderer
+        self.requests = iter(requests)
+        self.depth = depth
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue = deque()
+        self.exhausted = False
+        self.shown = 0
+        self.dropped = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.fill()
+
+    def fill(self):
+        """ start rendering until depth frames are queued """
+        while not self.exhausted and len(self.queue) < self.depth:
+            request = next(self.requests, None)
+            if request is None:
+                self.exhausted = True
+                return
+            self.queue.append(self.executor.submit(self.render, request))
+
+    def render(self, request: UpdateRequest):
+        """ runs in the background threads """
+        timer = StageTimer()
+        return self.renderer.render(request, timer), timer
+
+    def finished(self):
+        """ every frame was taken """
+        return self.exhausted and not self.queue
+
+    def next_frame(self):
+        """ the next (result, timer) if it is rendered, else None """
+        self.queue_depth = 0
+        for future in self.queue:
+            if not future.done():
+                break
+            self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+        if self.queue_depth == 0:
+            if self.queue:
+                self.dropped += 1
+            return None
+        frame = self.queue.popleft().result()
+        self.shown += 1
+        self.fill()
+        return frame
+
+    def frames(self):
+        """ every frame in order, waiting for the ones not yet rendered """
+        while not self.finished():
+            self.queue[0].result()
+            yield self.next_frame()
+
+    def summary(self):
+        """ one line with the counters for the status bar """
+        return (
+            f"frame {self.shown}, dropped {self.dropped}, "
+            f"queue {self.queue_depth}/{self.depth} "
+            f"(max {self.max_queue_depth})"
+        )
+
+    def close(self):
+        """ stop rendering the frames that were not taken """
+        self.executor.shutdown(wait=False, cancel_futures=True)
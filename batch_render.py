@@ -0,0 +1,308 @@
+"""
+Headless rendering of the contour maps and radar plots of a date range,
+the days are rendered in parallel and every product is written to
+the output directory together with the timing of every stage
+"""
+import argparse
+import math
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+try:
+    from matplotlib.figure import Figure
+except ImportError:  # only needed for the png output
+    Figure = None
+
+from contour_cache import ContourCache
+from data_access import datetime_to_key, open_data_store, shift_key
+from diagramcreator import (
+    PLOTLY_JS_DIR,
+    radar_figure,
+    radar_normalisation,
+    radar_values,
+    save_diagram_file
+)
+from instrumentation import (
+    PROFILE_MODES,
+    PipelineMetrics,
+    ProfileCapture,
+    StageTimer
+)
+from interpolation import GridInterpolator, GridResolutionPolicy
+from land_mask import load_land_mask
+from mapcreator import MapRenderer, SalinityMesh, UpdateRequest
+from mappage import standalone_map_html
+from worker_pool import bounded_map, worker_state
+
+OUTPUT_FORMATS = ["html", "geojson", "png"]
+MAP_LOCATION = [54.12, 8.37]
+POINT_BUDGET = 2000000
+
+
+def write_text(path: str, text: str):
+    """ written to a temporary file first """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+def save_map_png(path: str, mesh: SalinityMesh, legend: dict, title: str):
+    """ the contour bands of the mesh as a static image """
+    figure = Figure(figsize=(8, 8))
+    axes = figure.subplots()
+    axes.contourf(
+        mesh.x_lin, mesh.y_lin, mesh.z_mesh, legend['levels'],
+        colors=legend['colors'], alpha=0.5
+    )
+    # degrees of longitude are shorter than degrees of latitude
+    axes.set_aspect(1.0 / math.cos(math.radians(float(mesh.y_lin.mean()))))
+    axes.set_xlabel("Longitude")
+    axes.set_ylabel("Latitude")
+    axes.set_title(title)
+    figure.savefig(path, dpi=100)
+
+
+def save_radar_png(path: str, values: list):
+    """ the radar plot as a static image, needs kaleido """
+    radar_figure(values).write_image(path)
+
+
+def setup_worker(backend: str, path: str, method: str,
+                 grid_policy: GridResolutionPolicy, contour_cache_dir: str,
+                 profile_mode: str = None, profile_dir: str = None):
+    """ every worker process opens the data store and the caches once """
+    data_store = open_data_store(backend, path, prefetch_days=0)
+    interpolator = GridInterpolator(method)
+    contour_cache = None
+    if contour_cache_dir and os.path.isdir(contour_cache_dir):
+        contour_cache = ContourCache(
+            contour_cache_dir, data_store, interpolator, grid_policy
+        )
+    return {
+        'renderer': MapRenderer(
+            data_store, interpolator, grid_policy, POINT_BUDGET,
+            contour_cache, land_mask=load_land_mask()
+        ),
+        'global_data': radar_normalisation(data_store.sensor_statistics()),
+        'profile': ProfileCapture(profile_mode, profile_dir),
+    }
+
+
+def render_day(start_key: int, sal_val: float, smoothing: int,
+               output: str, formats: list):
+    """ render one day and write its products, returns the timer """
+    with worker_state()['profile'].capture(str(start_key // 10000)):
+        return render_products(start_key, sal_val, smoothing, output, formats)
+
+
+def render_products(start_key: int, sal_val: float, smoothing: int,
+                    output: str, formats: list):
+    """ the rendering of render_day, outside of the profiling """
+    renderer = worker_state()['renderer']
+    global_data = worker_state()['global_data']
+    timer = StageTimer()
+    request = UpdateRequest(
+        start_key, shift_key(start_key, 1), sal_val, smoothing
+    )
+    result = renderer.render(request, timer)
+    prefix = os.path.join(output, str(start_key // 10000))
+    if 'contours' not in result.layers:
+        return start_key, timer, []
+
+    written = list()
+    if "geojson" in formats:
+        with timer.stage("write geojson"):
+            path = prefix + "_contours.geojson"
+            write_text(path, result.layers['contours'])
+            written.append(path)
+    if "html" in formats:
+        with timer.stage("write html"):
+            write_text(
+                prefix + "_map.html",
+                standalone_map_html(MAP_LOCATION, result.layers)
+            )
+            # the plots link the plotly bundle next to them
+            save_diagram_file(
+                result.m_data, global_data, sal_val, result.radar,
+                prefix + "_radar.html", include_plotlyjs="directory"
+            )
+            written += [prefix + "_map.html", prefix + "_radar.html"]
+    if "png" in formats:
+        with timer.stage("write png"):
+            mesh = renderer.salinity_mesh(
+                result.m_data, request, timer
+            )
+            save_map_png(
+                prefix + "_map.png", mesh, result.layers['legend'],
+                f"Salinity {key_label(start_key)}, threshold {sal_val}"
+            )
+            written.append(prefix + "_map.png")
+            try:
+                save_radar_png(
+                    prefix + "_radar.png",
+                    radar_values(result.radar, global_data)
+                )
+                written.append(prefix + "_radar.png")
+            except (ImportError, RuntimeError, ValueError):  # no kaleido
+                pass
+    return start_key, timer, written
+
+
+def key_label(time_key: int):
+    """ YYYY-MM-DD HH:MM of a time key """
+    key = str(time_key)
+    return f"{key[0:4]}-{key[4:6]}-{key[6:8]} {key[8:10]}:{key[10:12]}"
+
+
+def timing_summary(timings: pd.DataFrame):
+    """ total, mean and max seconds per stage over the days """
+    return timings.agg(['sum', 'mean', 'max']).T.rename(
+        columns={'sum': 'total'}
+    )
+
+
+def render_range(
+    backend: str,
+    path: str,
+    output: str,
+    first_day: datetime,
+    last_day: datetime,
+    sal_val: float = 25.0,
+    smoothing: int = 0,
+    formats: list = None,
+    method: str = "linear",
+    grid_policy: GridResolutionPolicy = None,
+    contour_cache_dir: str = None,
+    workers: int = None,
+    profile_mode: str = None
+):
+    """
+    render every day of the range in a process pool, the timings of
+    every day are written to timings.csv in the output directory and
+    the statistics per stage to metrics.json
+    """
+    formats = formats or OUTPUT_FORMATS
+    if "png" in formats and Figure is None:
+        raise ImportError("the png output needs matplotlib")
+    grid_policy = grid_policy or GridResolutionPolicy()
+    os.makedirs(output, exist_ok=True)
+    if "html" in formats:
+        # copied once instead of by every worker
+        shutil.copyfile(
+            os.path.join(PLOTLY_JS_DIR, "plotly.min.js"),
+            os.path.join(output, "plotly.min.js")
+        )
+
+    pending = list()
+    day = first_day
+    while day <= last_day:
+        pending.append(
+            (datetime_to_key(day), sal_val, smoothing, output, formats)
+        )
+        day += timedelta(days=1)
+    print(f"{len(pending)} days to render")
+
+    rows = dict()
+    metrics = PipelineMetrics()
+    for start_key, timer, written in bounded_map(
+        render_day, pending, setup_worker,
+        (
+            backend, path, method, grid_policy, contour_cache_dir,
+            profile_mode, os.path.join(output, "profiles")
+        ),
+        workers
+    ):
+        rows[start_key // 10000] = timer.timings
+        metrics.add(timer)
+        metrics.count("files", len(written))
+        print(key_label(start_key), f"{len(written)} files")
+
+    timings = pd.DataFrame.from_dict(rows, orient='index').sort_index()
+    timings.index.name = 'day'
+    timings.to_csv(os.path.join(output, "timings.csv"))
+    metrics.to_json(os.path.join(output, "metrics.json"))
+    return timings
+
+
+def parse_args():
+    """ command line options of the batch renderer """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--backend", default=os.environ.get("CONCEPTVA_BACKEND", "sqlite"),
+        help="storage backend of the data, as for the app"
+    )
+    parser.add_argument(
+        "--database",
+        default=os.environ.get("CONCEPTVA_DATA", "./data/data_test.db"),
+        help="database file or directory of the day partitions"
+    )
+    parser.add_argument(
+        "--output", default="output",
+        help="directory the products and timings.csv are written to"
+    )
+    parser.add_argument(
+        "--first-day", required=True, help="first day, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--last-day", required=True, help="last day, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=25.0,
+        help="salinity splitting fresh and salt water"
+    )
+    parser.add_argument(
+        "--smoothing", type=int, default=0, help="smoothing level, 0 to 5"
+    )
+    parser.add_argument(
+        "--formats", nargs="+", default=OUTPUT_FORMATS,
+        choices=OUTPUT_FORMATS, help="products to write"
+    )
+    parser.add_argument(
+        "--interpolation", default="linear",
+        help="\"linear\", \"idw\" or \"nearest\""
+    )
+    parser.add_argument(
+        "--grid-resolution", type=int, default=500,
+        help="contour grid cells along the longer side"
+    )
+    parser.add_argument(
+        "--contour-cache", default=None,
+        help="directory of meshes precomputed by contour_cache.py"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of processes, defaults to the cpu count"
+    )
+    parser.add_argument(
+        "--profile", default=None, choices=PROFILE_MODES,
+        help="profile every day into the profiles directory of the output"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("started rendering...")
+    start_time = time.time()
+    day_timings = render_range(
+        args.backend,
+        args.database,
+        args.output,
+        datetime.strptime(args.first_day, "%Y-%m-%d"),
+        datetime.strptime(args.last_day, "%Y-%m-%d"),
+        args.threshold,
+        args.smoothing,
+        args.formats,
+        args.interpolation,
+        GridResolutionPolicy(full_resolution=args.grid_resolution),
+        args.contour_cache,
+        args.workers,
+        args.profile
+    )
+    print("seconds per stage:")
+    print(timing_summary(day_timings).to_string(float_format="%.3f"))
+    print("rendering done in " + str(time.time() - start_time) + " seconds")
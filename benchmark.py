@@ -0,0 +1,652 @@
+"""
+Micro benchmarks for the data pipeline,
+runs offline on synthetic data
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import folium
+import numpy
+import pandas as pd
+from scipy.interpolate import griddata
+
+from animation import FramePrefetcher, animation_requests
+from database_builder import (
+    SENSOR_COLUMNS,
+    LocalDirectorySource,
+    build_label_index,
+    create_writer,
+    process_extrapolated_data,
+    write_into_database
+)
+from data_access import COLUMNAR_FORMATS, MapData, open_data_store, shift_key
+from diagramcreator import (
+    SortedExtremes,
+    radar_normalisation,
+    save_diagram_file,
+    sensor_block,
+    threshold_extremes
+)
+from isobands import contour_bands_geojson
+from mapcreator import (
+    MapRenderer,
+    UpdateRequest,
+    points_payload,
+    salinity_levels
+)
+from mappage import legend_data, update_script
+from instrumentation import StageTimer
+from interpolation import (
+    INTERPOLATION_METHODS,
+    GridInterpolator,
+    GridResolutionPolicy
+)
+from synthetic_data import (
+    create_synthetic_frames,
+    write_netcdf_fixtures,
+    write_scaled_dataset,
+    write_synthetic_dataset
+)
+from window_aggregation import WindowAggregator
+
+
+def process_extrapolated_data_iterrows(
+    df_ext: pd.DataFrame, df_obs: pd.DataFrame
+):
+    """ the former row by row implementation, kept as reference """
+    sen_list = [[] for _ in range(7)]
+    for _, row in df_ext.iterrows():
+        mask = df_obs['label'].values == row['label']
+        for i, sensor_name in enumerate(SENSOR_COLUMNS):
+            sen_list[i].append(df_obs[mask][sensor_name].values[0])
+
+    for i, sensor_name in enumerate(SENSOR_COLUMNS):
+        df_ext[sensor_name] = sen_list[i]
+
+
+def threshold_extremes_pandas(m_data: MapData, salinity_value: float):
+    """ the former filtered copies per side, kept as reference """
+    merged_data = pd.concat([
+        m_data.data_obs,
+        m_data.data_bw,
+        m_data.data_fw
+    ])
+    below = merged_data[merged_data["sensor_1"] <= salinity_value]
+    above = merged_data[merged_data["sensor_1"] > salinity_value]
+    return {
+        'max_above': above[SENSOR_COLUMNS].max().to_numpy(),
+        'min_above': above[SENSOR_COLUMNS].min().to_numpy(),
+        'max_below': below[SENSOR_COLUMNS].max().to_numpy(),
+        'min_below': below[SENSOR_COLUMNS].min().to_numpy(),
+    }
+
+
+def measure(function, *args, repeat: int = 3, **kwargs):
+    """ best wall clock time of several runs in seconds """
+    best = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def bench_sensor_join(n_obs: int = 2000, n_ext: int = 2000):
+    """ compare the vectorized sensor join against the row by row one """
+    df_obs, df_ext = create_synthetic_frames(n_obs, n_ext)
+
+    df_reference = df_ext.copy()
+    time_iterrows = measure(
+        process_extrapolated_data_iterrows, df_reference, df_obs, repeat=1
+    )
+
+    df_vectorized = df_ext.copy()
+    time_vectorized = measure(
+        process_extrapolated_data, df_vectorized, df_obs
+    )
+
+    label_index = build_label_index(df_obs)
+    time_reused_index = measure(
+        process_extrapolated_data, df_ext.copy(), label_index=label_index
+    )
+
+    pd.testing.assert_frame_equal(df_reference, df_vectorized)
+
+    print(f"sensor join with {n_obs} obs and {n_ext} extrapolated rows:")
+    print(f"  iterrows:             {time_iterrows:.4f} s")
+    print(f"  vectorized:           {time_vectorized:.4f} s")
+    print(f"  vectorized, reused:   {time_reused_index:.4f} s")
+    print(f"  speedup:              {time_iterrows / time_reused_index:.1f}x")
+
+
+def bench_ingest(n_files: int = 48, n_ext: int = 5000, workers: int = None):
+    """ throughput of the ingest pipeline on generated NetCDF fixtures """
+    with tempfile.TemporaryDirectory() as directory:
+        source_dir = os.path.join(directory, "source")
+        write_netcdf_fixtures(source_dir, n_files=n_files, n_ext=n_ext)
+        database_path = os.path.join(directory, "bench.db")
+
+        start_time = time.perf_counter()
+        write_into_database(
+            LocalDirectorySource(source_dir), database_path, workers
+        )
+        elapsed = time.perf_counter() - start_time
+
+    rows = n_files * n_ext * 2
+    print(f"ingest of {n_files} files with {n_ext} rows each:")
+    print(f"  total:                {elapsed:.2f} s")
+    print(f"  files per second:     {n_files / elapsed:.1f}")
+    print(f"  rows per second:      {rows / elapsed:.0f}")
+
+
+def cold_load(backend: str, path: str, start_key: int, days: int):
+    """ runs in a fresh process: open the store and read the window """
+    start_time = time.perf_counter()
+    data_store = open_data_store(backend, path, prefetch_days=0)
+    m_data = data_store.get_window(start_key, shift_key(start_key, days))
+    elapsed = time.perf_counter() - start_time
+    rows = sum(len(df.index) for df in (
+        m_data.data_obs, m_data.data_bw, m_data.data_fw
+    ))
+    data_store.close()
+    # ru_maxrss is given in kilobytes on linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return elapsed, rows, max_rss
+
+
+def bench_storage_backends(n_days: int = 7, n_ext: int = 20000):
+    """ cold load time and peak memory of SQLite against the columnar
+    backends, every load runs in its own process """
+    context = multiprocessing.get_context("spawn")
+    start_key = 201306010000
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {"sqlite": os.path.join(directory, "bench.db")}
+        for file_format in COLUMNAR_FORMATS:
+            paths[file_format] = os.path.join(directory, file_format)
+        for backend, path in paths.items():
+            write_synthetic_dataset(
+                create_writer(path, backend), n_days=n_days, n_ext=n_ext
+            )
+
+        print(f"cold load, {n_days} days with {n_ext} rows per hour:")
+        for days in (1, n_days):
+            for backend, path in paths.items():
+                with context.Pool(1) as pool:
+                    elapsed, rows, max_rss = pool.apply(
+                        cold_load, (backend, path, start_key, days)
+                    )
+                print(
+                    f"  {backend:8s} {days} day(s): {elapsed:.3f} s, "
+                    f"{rows} rows, peak rss {max_rss:.0f} MB"
+                )
+
+
+def bench_interpolation(n_points: int = 20000, resolution: int = 500):
+    """ griddata against the interpolation engine with a cold and a
+    warm geometry cache, the warm case is a new day on the same points """
+    rng = numpy.random.default_rng(0)
+    x_data = rng.uniform(6.0, 10.0, n_points)
+    y_data = rng.uniform(53.0, 56.0, n_points)
+    z_data = rng.uniform(0.0, 35.0, n_points)
+    x_lin = numpy.linspace(x_data.min(), x_data.max(), resolution)
+    y_lin = numpy.linspace(y_data.min(), y_data.max(), resolution)
+    x_mesh, y_mesh = numpy.meshgrid(x_lin, y_lin)
+
+    print(f"interpolation of {n_points} points on {resolution}^2 cells:")
+    time_griddata = measure(
+        griddata, (x_data, y_data), z_data, (x_mesh, y_mesh),
+        method='linear'
+    )
+    print(f"  griddata:             {time_griddata:.4f} s")
+    for method in INTERPOLATION_METHODS:
+        interpolator = GridInterpolator(method)
+        time_cold = measure(
+            lambda: GridInterpolator(method).interpolate(
+                x_data, y_data, z_data, x_lin, y_lin
+            ), repeat=1
+        )
+        interpolator.interpolate(x_data, y_data, z_data, x_lin, y_lin)
+        time_warm = measure(
+            interpolator.interpolate,
+            x_data, y_data, z_data[::-1].copy(), x_lin, y_lin
+        )
+        print(
+            f"  {method + ':':22s}{time_cold:.4f} s cold, "
+            f"{time_warm:.4f} s warm"
+        )
+
+
+def bench_grid_resolution(n_points: int = 20000):
+    """ interpolation and contouring time for several grid resolutions """
+    rng = numpy.random.default_rng(0)
+    x_data = rng.uniform(6.0, 10.0, n_points)
+    y_data = rng.uniform(53.0, 56.0, n_points)
+    z_data = rng.uniform(0.0, 35.0, n_points)
+
+    print(f"grid resolution with {n_points} points:")
+    for resolution in (120, 250, 500):
+        policy = GridResolutionPolicy(full_resolution=resolution)
+        x_lin, y_lin = policy.grid(x_data, y_data)
+        time_interpolation = measure(
+            lambda: GridInterpolator().interpolate(
+                x_data, y_data, z_data, x_lin, y_lin
+            ), repeat=1
+        )
+        z_mesh = GridInterpolator().interpolate(
+            x_data, y_data, z_data, x_lin, y_lin
+        )
+        time_contours = measure(
+            contour_bands_geojson, x_lin, y_lin, z_mesh,
+            [0.0, 10.0, 25.0, 30.0, 35.0],
+            ['#b5212f', '#de7881', '#77b5d4', '#06618f']
+        )
+        print(
+            f"  {len(x_lin)}x{len(y_lin)}: interpolation "
+            f"{time_interpolation:.4f} s, contours {time_contours:.4f} s"
+        )
+
+
+def full_map_page(geo_json: str = None, df: pd.DataFrame = None,
+                  levels: list = None, colors: list = None):
+    """ the page every update used to load with setHtml, a new folium
+    map with the contours or a circle per point (at most 2000) """
+    fol_map = folium.Map(location=[54.12, 8.37], zoom_start=10)
+    if geo_json is not None:
+        folium.GeoJson(
+            geo_json,
+            style_function=lambda x: {
+                'color': x['properties']['stroke'],
+                'weight': x['properties']['stroke-width'],
+                'fillColor': x['properties']['fill'],
+                'opacity': 0.6,
+            }).add_to(fol_map)
+    if df is not None:
+        df = df.iloc[::max(1, len(df.index) // 2000)]
+        classes = numpy.searchsorted(levels[1:-1], df['sensor_1'])
+        for latitude, longitude, color_class in zip(
+            df['latitude'], df['longitude'], classes
+        ):
+            folium.vector_layers.Circle(
+                location=[latitude, longitude], radius=5,
+                color=colors[color_class], fill=True, fillOpacity=1.0,
+                fillColor=colors[color_class]
+            ).add_to(fol_map)
+    return fol_map.get_root().render()
+
+
+def bench_map_update(n_points: int = 20000):
+    """ size and build time of an update as a full page for setHtml
+    against the script replacing the layers through runJavaScript """
+    rng = numpy.random.default_rng(0)
+    df = pd.DataFrame({
+        'latitude': rng.uniform(53.0, 56.0, n_points),
+        'longitude': rng.uniform(6.0, 10.0, n_points),
+        'sensor_1': rng.uniform(0.0, 35.0, n_points),
+    })
+    levels, colors = salinity_levels(0.0, 35.0, 25.0)
+    policy = GridResolutionPolicy()
+    x_lin, y_lin = policy.grid(
+        df['longitude'].to_numpy(), df['latitude'].to_numpy()
+    )
+    geo_json = contour_bands_geojson(
+        x_lin, y_lin, GridInterpolator().interpolate(
+            df['longitude'].to_numpy(), df['latitude'].to_numpy(),
+            df['sensor_1'].to_numpy(), x_lin, y_lin
+        ), levels, colors
+    )
+    legend = legend_data(levels, colors)
+
+    print(f"map update with {n_points} points:")
+    for name, page, script in (
+        (
+            "contours",
+            lambda: full_map_page(geo_json),
+            lambda: update_script(contours=geo_json, legend=legend)
+        ),
+        (
+            "points",
+            lambda: full_map_page(df=df, levels=levels, colors=colors),
+            lambda: update_script(
+                points=points_payload(df, levels, colors), legend=legend
+            )
+        ),
+    ):
+        time_page = measure(page, repeat=1)
+        time_script = measure(script)
+        print(
+            f"  {name:8s} setHtml page {len(page()) / 1024:.0f} kB "
+            f"in {time_page:.3f} s, runJavaScript update "
+            f"{len(script()) / 1024:.0f} kB in {time_script:.3f} s"
+        )
+
+
+def bench_radar_statistics(n_ext: int = 50000):
+    """ threshold statistics of the radar plot, filtered copies against
+    the masked reduction and the lookup in the sorted window """
+    df_obs, df_ext = create_synthetic_frames(2000, n_ext)
+    process_extrapolated_data(df_ext, df_obs)
+    m_data = MapData(data_obs=df_obs, data_bw=df_ext, data_fw=df_ext)
+    block = sensor_block(m_data)
+    sorted_extremes = SortedExtremes(block)
+    thresholds = numpy.linspace(
+        numpy.nanmin(block[0]), numpy.nanmax(block[0]), 50
+    )
+
+    for salinity_value in thresholds[::10]:
+        expected = threshold_extremes_pandas(m_data, salinity_value)
+        for extremes in (
+            threshold_extremes(block, salinity_value),
+            sorted_extremes.extremes(salinity_value)
+        ):
+            for name, values in expected.items():
+                numpy.testing.assert_allclose(extremes[name], values)
+
+    def sweep(function):
+        for salinity_value in thresholds:
+            function(salinity_value)
+
+    time_pandas = measure(
+        sweep, lambda value: threshold_extremes_pandas(m_data, value)
+    )
+    time_masked = measure(
+        sweep, lambda value: threshold_extremes(sensor_block(m_data), value)
+    )
+    time_build = measure(lambda: SortedExtremes(sensor_block(m_data)))
+    time_sorted = measure(sweep, sorted_extremes.extremes)
+
+    print(f"radar statistics of {len(block[0])} rows, 50 thresholds:")
+    print(f"  filtered copies:      {time_pandas / 50 * 1000:.3f} ms each")
+    print(f"  masked reduction:     {time_masked / 50 * 1000:.3f} ms each")
+    print(f"  sorted window build:  {time_build * 1000:.3f} ms once")
+    print(f"  sorted lookup:        {time_sorted / 50 * 1000:.3f} ms each")
+
+
+def bench_animation(n_days: int = 2, n_ext: int = 5000, depth: int = 8):
+    """ frames per second of the hourly playback, rendered ahead
+    in background threads, with the coarse and the full grid """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        write_synthetic_dataset(
+            create_writer(path), n_days=n_days, n_ext=n_ext
+        )
+        start_key = 201306010000
+        last_key = shift_key(start_key, n_days, hours=-1)
+
+        print(f"hourly playback of {n_days} days, {n_ext} rows per hour:")
+        for preview in (True, False):
+            data_store = open_data_store("sqlite", path, prefetch_days=0)
+            renderer = MapRenderer(
+                data_store, GridInterpolator(), GridResolutionPolicy(),
+                2000000
+            )
+            prefetcher = FramePrefetcher(
+                renderer,
+                animation_requests(
+                    start_key, last_key, 1,
+                    UpdateRequest(0, 0, 25.0, preview=preview)
+                ),
+                depth=depth
+            )
+            start_time = time.perf_counter()
+            frames = sum(1 for _ in prefetcher.frames())
+            elapsed = time.perf_counter() - start_time
+            prefetcher.close()
+            data_store.close()
+            print(
+                f"  {'coarse' if preview else 'full'} grid: "
+                f"{frames / elapsed:.1f} frames/s, {prefetcher.summary()}"
+            )
+
+
+def bench_window_aggregation(n_days: int = 8, n_ext: int = 2000,
+                             steps: int = 24):
+    """ a one week window moved hour by hour, slid over the partial
+    aggregates of the hours against aggregating every window again """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        write_synthetic_dataset(
+            create_writer(path), n_days=n_days, n_ext=n_ext
+        )
+        start_key = 201306010000
+        # configured like the application, prefetching the next days
+        data_store = open_data_store("sqlite", path)
+
+        def slide(new_aggregator: bool):
+            aggregator = WindowAggregator(data_store)
+            for step in range(steps):
+                if new_aggregator:
+                    aggregator = WindowAggregator(data_store)
+                begin = shift_key(start_key, hours=step)
+                aggregator.frame(
+                    begin, shift_key(begin, days=7), "mean"
+                )
+
+        print(f"one week window moved {steps} hours:")
+        for name, new_aggregator in (("sliding", False), ("recompute", True)):
+            elapsed = measure(slide, new_aggregator, repeat=1)
+            print(f"  {name}: {elapsed / steps * 1000:.1f} ms per step")
+        data_store.close()
+
+
+# results of the pipeline suite the later runs are compared against
+BASELINE_PATH = "benchmark_baseline.json"
+# slower than the baseline by more than this fraction is a regression
+REGRESSION_TOLERANCE = 0.25
+# differences below are timer noise, not regressions
+REGRESSION_MIN_SECONDS = 0.005
+
+
+def best_time(setup, function, repeat: int = 3):
+    """ best wall clock time of function(setup()), the setup of every
+    run is not timed so each run starts without warm caches """
+    best = float('inf')
+    for _ in range(repeat):
+        argument = setup()
+        start_time = time.perf_counter()
+        function(argument)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+
+def bench_pipeline(scale: float = 1, n_days: int = 2, repeat: int = 3):
+    """
+    seconds of the pipeline steps on the synthetic dataset at a scale
+    of june 2013: building the database, opening it like read_db,
+    querying a day, its contour map, its points and its radar plot
+    """
+    results = dict()
+    start_key = 201306010000
+    end_key = shift_key(start_key, 1)
+    request = UpdateRequest(start_key, end_key, 25.0)
+    point_request = UpdateRequest(start_key, end_key, 25.0, show_points=True)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        start_time = time.perf_counter()
+        write_scaled_dataset(create_writer(path), scale, n_days)
+        results['build'] = time.perf_counter() - start_time
+
+        def open_store(_=None):
+            data_store = open_data_store("sqlite", path, prefetch_days=0)
+            data_store.sensor_statistics()
+            return data_store
+
+        def new_renderer():
+            return MapRenderer(
+                open_store(), GridInterpolator(), GridResolutionPolicy(),
+                2000000
+            )
+
+        def renderer_with_window():
+            renderer = new_renderer()
+            return renderer, renderer.get_data_for_time_range(
+                start_key, end_key
+            )
+
+        results['read_db'] = best_time(lambda: None, open_store, repeat)
+        results['get_data_for_time_range'] = best_time(
+            new_renderer,
+            lambda renderer: renderer.get_data_for_time_range(
+                start_key, end_key
+            ),
+            repeat
+        )
+        results['draw_contour_map'] = best_time(
+            renderer_with_window,
+            lambda prepared: prepared[0].draw_contour_map(
+                prepared[1], request, StageTimer()
+            ),
+            repeat
+        )
+        results['draw_points'] = best_time(
+            renderer_with_window,
+            lambda prepared: prepared[0].draw_points(
+                prepared[1], point_request
+            ),
+            repeat
+        )
+
+        data_store = open_store()
+        global_data = radar_normalisation(data_store.sensor_statistics())
+        m_data = data_store.get_window(start_key, end_key)
+        radar_path = os.path.join(directory, "radarplot.html")
+        results['save_diagram_file'] = best_time(
+            lambda: m_data,
+            lambda window: save_diagram_file(
+                window, global_data, 25.0, path=radar_path,
+                include_plotlyjs="directory"
+            ),
+            repeat
+        )
+        data_store.close()
+    return results
+
+
+def environment():
+    """ what the timings of a baseline depend on besides the code """
+    return {
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def run_suite(scales: list, n_days: int, repeat: int):
+    """ the pipeline steps at every scale, keyed "<scale>x/<step>" """
+    results = dict()
+    for scale in scales:
+        print(f"pipeline at {scale:g}x june 2013, {n_days} day(s):")
+        for step, seconds in bench_pipeline(scale, n_days, repeat).items():
+            results[f"{scale:g}x/{step}"] = seconds
+            print(f"  {step:26s} {seconds:.4f} s")
+    return results
+
+
+def save_baseline(results: dict, path: str = BASELINE_PATH):
+    """ the results together with the environment they were taken in """
+    with open(path, "w") as file:
+        json.dump(
+            {'environment': environment(), 'results': results},
+            file, indent=1, sort_keys=True
+        )
+
+
+def compare_baseline(results: dict, path: str = BASELINE_PATH,
+                     tolerance: float = REGRESSION_TOLERANCE):
+    """ print every step against the baseline, returns the steps
+    slower than the baseline by more than the tolerance """
+    with open(path) as file:
+        baseline = json.load(file)
+    if baseline['environment'] != environment():
+        print("the baseline was taken in another environment:")
+        print(f"  {baseline['environment']}")
+
+    regressions = list()
+    print(f"against {path}:")
+    for name, seconds in results.items():
+        reference = baseline['results'].get(name)
+        if reference is None:
+            print(f"  {name:30s} {seconds:.4f} s, not in the baseline")
+            continue
+        ratio = seconds / reference if reference > 0 else float('inf')
+        regressed = ratio > 1.0 + tolerance \
+            and seconds - reference > REGRESSION_MIN_SECONDS
+        if regressed:
+            regressions.append(name)
+        print(
+            f"  {name:30s} {seconds:.4f} s, baseline {reference:.4f} s, "
+            f"{ratio:.2f}x" + (" REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+def parse_args():
+    """ command line options, without --suite the micro benchmarks run """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--suite", action="store_true",
+        help="run the pipeline suite on the synthetic datasets instead"
+    )
+    parser.add_argument(
+        "--scales", type=float, nargs="+", default=[1, 10],
+        help="sizes of the datasets relative to june 2013, e.g. 1 10 100"
+    )
+    parser.add_argument(
+        "--days", type=int, default=2, help="days of every dataset"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="runs of every step, the best one counts"
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINE_PATH, help="file of the baseline"
+    )
+    parser.add_argument(
+        "--save-baseline", action="store_true",
+        help="save the results as the new baseline"
+    )
+    parser.add_argument(
+        "--compare", action="store_true",
+        help="compare against the baseline, exits with 1 on a regression"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=REGRESSION_TOLERANCE,
+        help="allowed slowdown against the baseline, 0.25 is 25%%"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.suite:
+        bench_sensor_join()
+        bench_ingest()
+        bench_storage_backends()
+        bench_interpolation()
+        bench_grid_resolution()
+        bench_map_update()
+        bench_radar_statistics()
+        bench_animation()
+        bench_window_aggregation()
+        sys.exit(0)
+
+    suite_results = run_suite(args.scales, args.days, args.repeat)
+    if args.compare:
+        regressed_steps = compare_baseline(
+            suite_results, args.baseline, args.tolerance
+        )
+        if regressed_steps:
+            print("regressions: " + ", ".join(regressed_steps))
+            sys.exit(1)
+    if args.save_baseline:
+        save_baseline(suite_results, args.baseline)
+        print("baseline saved to " + args.baseline)
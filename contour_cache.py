@@ -0,0 +1,285 @@
+"""
+On-disk cache of the contour meshes of whole days,
+filled offline by running this file and read by the app before
+interpolating, every day and smoothing level is a compressed npz file
+"""
+import argparse
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy
+
+from data_access import DataStore, datetime_to_key, open_data_store, shift_key
+from interpolation import GridInterpolator, GridResolutionPolicy
+from mapcreator import SalinityMesh, compute_mesh, create_salinity_df
+from worker_pool import bounded_map, worker_state
+
+CONTOUR_CACHE_DIR = "data/contour_cache"
+INDEX_FILE_NAME = "index.db"
+SMOOTHING_LEVELS = list(range(0, 6))
+# the range selectable in the app
+FIRST_DAY = datetime(2013, 1, 1)
+LAST_DAY = datetime(2013, 12, 31)
+
+
+def mesh_settings(
+    interpolator: GridInterpolator, grid_policy: GridResolutionPolicy
+):
+    """ everything besides the data a full resolution mesh depends on """
+    return repr((
+        interpolator.method, interpolator.neighbours, interpolator.power,
+        interpolator.max_distance, grid_policy.full_resolution,
+        grid_policy.min_resolution, grid_policy.cells_per_point,
+    ))
+
+
+class ContourCache:
+    """
+    the index maps (start of the day, smoothing) to the file of the mesh
+    and the digest of the data it was computed from, an entry is only
+    used while the digest of the days in the data store still matches
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        data_store: DataStore,
+        interpolator: GridInterpolator,
+        grid_policy: GridResolutionPolicy
+    ):
+        self.directory = directory
+        self.data_store = data_store
+        self.settings = mesh_settings(interpolator, grid_policy)
+        self.local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+        self.connection().execute(
+            "CREATE TABLE IF NOT EXISTS CONTOURS ("
+            "start_key INTEGER NOT NULL, "
+            "smoothing INTEGER NOT NULL, "
+            "settings TEXT NOT NULL, "
+            "digest TEXT NOT NULL, "
+            "file_name TEXT NOT NULL, "
+            "PRIMARY KEY (start_key, smoothing))"
+        )
+        self.connection().commit()
+
+    def connection(self):
+        """ sqlite connections can not be shared between threads """
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(
+                os.path.join(self.directory, INDEX_FILE_NAME)
+            )
+        return self.local.conn
+
+    def entries(self):
+        """ (start_key, smoothing) -> (settings, digest) of the index """
+        return {
+            (start_key, smoothing): (settings, digest)
+            for start_key, smoothing, settings, digest in
+            self.connection().execute(
+                "SELECT start_key, smoothing, settings, digest FROM CONTOURS"
+            )
+        }
+
+    def get(self, start_key: int, end_key: int, smoothing: int):
+        """ the cached mesh of the day, None if there is no valid one """
+        if end_key != shift_key(start_key, 1):
+            return None
+        row = self.connection().execute(
+            "SELECT settings, digest, file_name FROM CONTOURS "
+            "WHERE start_key = ? AND smoothing = ?",
+            (start_key, smoothing)
+        ).fetchone()
+        if row is None or row[0] != self.settings or \
+                row[1] != self.data_store.content_digest(start_key, end_key):
+            return None
+        path = os.path.join(self.directory, row[2])
+        if not os.path.exists(path):
+            return None
+        return read_mesh(path)
+
+    def add(self, start_key: int, smoothing: int, digest: str,
+            file_name: str):
+        """ record a mesh file written by write_mesh """
+        self.connection().execute(
+            "INSERT OR REPLACE INTO CONTOURS VALUES (?, ?, ?, ?, ?)",
+            (start_key, smoothing, self.settings, digest, file_name)
+        )
+        self.connection().commit()
+
+
+def mesh_file_name(start_key: int, smoothing: int):
+    """ file of a day and smoothing level inside the cache directory """
+    return f"{start_key}_s{smoothing}.npz"
+
+
+def write_mesh(path: str, mesh: SalinityMesh):
+    """ compressed, written to a temporary file first so a crashed
+    batch never leaves a broken file behind """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        numpy.savez_compressed(
+            file,
+            x_lin=mesh.x_lin,
+            y_lin=mesh.y_lin,
+            z_mesh=mesh.z_mesh.astype(numpy.float32),
+            sal_range=numpy.array([mesh.sal_min, mesh.sal_max])
+        )
+    os.replace(tmp_path, path)
+
+
+def read_mesh(path: str):
+    """ the mesh stored by write_mesh """
+    with numpy.load(path) as data:
+        return SalinityMesh(
+            data['x_lin'], data['y_lin'],
+            data['z_mesh'].astype(float),
+            float(data['sal_range'][0]), float(data['sal_range'][1])
+        )
+
+
+def setup_worker(backend: str, path: str, method: str,
+                 grid_policy: GridResolutionPolicy):
+    """ every worker process opens the data store once """
+    return {
+        'data_store': open_data_store(backend, path, prefetch_days=0),
+        'interpolator': GridInterpolator(method),
+        'grid_policy': grid_policy,
+    }
+
+
+def compute_day(start_key: int, smoothing_levels: list, directory: str):
+    """
+    compute and write the meshes of one day for the smoothing levels,
+    the interpolation weights are shared between the levels
+    """
+    state = worker_state()
+    end_key = shift_key(start_key, 1)
+    digest = state['data_store'].content_digest(start_key, end_key)
+    df = create_salinity_df(
+        state['data_store'].get_window(start_key, end_key)
+    )
+    written = list()
+    if df.empty:
+        return start_key, digest, written
+    for smoothing in smoothing_levels:
+        mesh = compute_mesh(
+            df, state['interpolator'], state['grid_policy'], smoothing
+        )
+        file_name = mesh_file_name(start_key, smoothing)
+        write_mesh(os.path.join(directory, file_name), mesh)
+        written.append((smoothing, file_name))
+    return start_key, digest, written
+
+
+def precompute(
+    backend: str,
+    path: str,
+    directory: str = CONTOUR_CACHE_DIR,
+    method: str = "linear",
+    grid_policy: GridResolutionPolicy = None,
+    smoothing_levels: list = None,
+    first_day: datetime = FIRST_DAY,
+    last_day: datetime = LAST_DAY,
+    workers: int = None
+):
+    """
+    fill the cache for every day of the range in a process pool,
+    days whose entries are still valid are skipped
+    """
+    grid_policy = grid_policy or GridResolutionPolicy()
+    smoothing_levels = smoothing_levels or SMOOTHING_LEVELS
+    data_store = open_data_store(backend, path, prefetch_days=0)
+    cache = ContourCache(
+        directory, data_store, GridInterpolator(method), grid_policy
+    )
+    entries = cache.entries()
+
+    pending = list()
+    day = first_day
+    while day <= last_day:
+        start_key = datetime_to_key(day)
+        digest = data_store.content_digest(
+            start_key, shift_key(start_key, 1)
+        )
+        missing = [
+            smoothing for smoothing in smoothing_levels
+            if entries.get((start_key, smoothing)) != (cache.settings, digest)
+        ]
+        if missing:
+            pending.append((start_key, missing, directory))
+        day += timedelta(days=1)
+    data_store.close()
+    print(f"{len(pending)} days to compute")
+
+    for start_key, digest, written in bounded_map(
+        compute_day, pending, setup_worker,
+        (backend, path, method, grid_policy), workers
+    ):
+        for smoothing, file_name in written:
+            cache.add(start_key, smoothing, digest, file_name)
+        print(start_key)
+
+
+def parse_args():
+    """ command line options of the batch """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--backend", default=os.environ.get("CONCEPTVA_BACKEND", "sqlite"),
+        help="storage backend of the data, as for the app"
+    )
+    parser.add_argument(
+        "--database",
+        default=os.environ.get("CONCEPTVA_DATA", "./data/data_test.db"),
+        help="database file or directory of the day partitions"
+    )
+    parser.add_argument(
+        "--cache-dir", default=CONTOUR_CACHE_DIR,
+        help="directory of the cached meshes and their index"
+    )
+    parser.add_argument(
+        "--interpolation", default="linear",
+        help="interpolation method, must match the one of the app"
+    )
+    parser.add_argument(
+        "--grid-resolution", type=int, default=500,
+        help="contour grid cells along the longer side"
+    )
+    parser.add_argument(
+        "--smoothing", type=int, nargs="+", default=SMOOTHING_LEVELS,
+        help="smoothing levels to compute"
+    )
+    parser.add_argument(
+        "--first-day", default=FIRST_DAY.strftime("%Y-%m-%d"),
+        help="first day to compute, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--last-day", default=LAST_DAY.strftime("%Y-%m-%d"),
+        help="last day to compute, YYYY-MM-DD"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of processes, defaults to the cpu count"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("started precomputing contours...")
+    start_time = time.time()
+    precompute(
+        args.backend,
+        args.database,
+        args.cache_dir,
+        args.interpolation,
+        GridResolutionPolicy(full_resolution=args.grid_resolution),
+        args.smoothing,
+        datetime.strptime(args.first_day, "%Y-%m-%d"),
+        datetime.strptime(args.last_day, "%Y-%m-%d"),
+        args.workers
+    )
+    print("precomputing done in " + str(time.time() - start_time) + " seconds")
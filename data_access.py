@@ -0,0 +1,526 @@
+"""
+Windowed access to the measurement data,
+only the time range shown in the UI is read from the database
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the columnar backends
+    pa = None
+
+SENSOR_COLUMNS = [f"sensor_{i}" for i in range(1, 8)]
+TIME_COLUMNS = {"OBS": "time", "BW": "initial_time", "FW": "initial_time"}
+KEY_FORMAT = "%Y%m%d%H%M"
+COLUMNAR_FORMATS = ["parquet", "arrow"]
+CATALOG_FILE_NAME = "catalog.db"
+
+
+@dataclass
+class MapData:
+    """ dataclass for the used point data """
+    data_obs: pd.DataFrame = field(default_factory=pd.DataFrame)
+    data_bw: pd.DataFrame = field(default_factory=pd.DataFrame)
+    data_fw: pd.DataFrame = field(default_factory=pd.DataFrame)
+
+
+class TimeIndexedFrame:
+    """
+    a frame sorted on its integer time key, windows are cut out
+    with a binary search and returned as slices instead of masked copies
+    """
+
+    def __init__(self, df: pd.DataFrame, time_column: str):
+        # the time key is converted once here and not on every query
+        if df[time_column].dtype == object:
+            df = df.assign(**{time_column: pd.to_numeric(
+                df[time_column].str.decode("ascii")
+            )})
+        df = df.astype({time_column: 'int64'})
+        if not df[time_column].is_monotonic_increasing:
+            df = df.sort_values(time_column, kind='stable')
+        self.df = df.reset_index(drop=True)
+        self.keys = self.df[time_column].to_numpy()
+
+    def slice(self, start_key: int, end_key: int):
+        """ rows between both keys (inclusive), O(log n + k) """
+        begin = self.keys.searchsorted(start_key, side='left')
+        end = self.keys.searchsorted(end_key, side='right')
+        return self.df.iloc[begin:end]
+
+
+class TimeIndexedData:
+    """ the time indexed frames of OBS, BW and FW for a time range """
+
+    def __init__(self, m_data: MapData):
+        self.obs = TimeIndexedFrame(m_data.data_obs, TIME_COLUMNS["OBS"])
+        self.bw = TimeIndexedFrame(m_data.data_bw, TIME_COLUMNS["BW"])
+        self.fw = TimeIndexedFrame(m_data.data_fw, TIME_COLUMNS["FW"])
+
+    def slice(self, start_key: int, end_key: int):
+        """ the MapData between both keys (inclusive) """
+        return MapData(
+            data_obs=self.obs.slice(start_key, end_key),
+            data_bw=self.bw.slice(start_key, end_key),
+            data_fw=self.fw.slice(start_key, end_key),
+        )
+
+
+def key_to_datetime(time_key: int):
+    """ 201306010000 -> datetime(2013, 6, 1, 0, 0) """
+    return datetime.strptime(str(time_key), KEY_FORMAT)
+
+
+def datetime_to_key(date_time: datetime):
+    """ datetime(2013, 6, 1, 0, 0) -> 201306010000 """
+    return int(date_time.strftime(KEY_FORMAT))
+
+
+def shift_key(time_key: int, days: int = 0, hours: int = 0):
+    """ move a time key by a number of days and hours """
+    return datetime_to_key(
+        key_to_datetime(time_key) + timedelta(days=days, hours=hours)
+    )
+
+
+def window_dtypes(table_name: str):
+    """ dtypes of the columns of a window of the table, the same for
+    every backend and for empty windows """
+    dtypes = {TIME_COLUMNS[table_name]: 'int64'}
+    for column in ["latitude", "longitude"] + SENSOR_COLUMNS:
+        dtypes[column] = 'float64'
+    return dtypes
+
+
+def day_range_condition(start_key: int, end_key: int):
+    """ where clause and parameters selecting the days of a window """
+    if start_key is None:
+        return "", ()
+    return "WHERE day BETWEEN ? AND ? ", (start_key // 10000, end_key // 10000)
+
+
+def read_statistics(
+    conn: sqlite3.Connection, start_key: int = None, end_key: int = None
+):
+    """ per sensor aggregates from the statistics table of the build,
+    over all data or over the days of the given window """
+    condition, params = day_range_condition(start_key, end_key)
+    rows = conn.execute(
+        "SELECT sensor, SUM(count), SUM(total), "
+        f"MIN(minimum), MAX(maximum) FROM STATISTICS {condition}"
+        "GROUP BY sensor",
+        params
+    ).fetchall()
+    return statistics_from_rows(rows)
+
+
+def create_statistics_table(conn: sqlite3.Connection):
+    """ count, sum, min and max per table, day and sensor """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS STATISTICS ("
+        "table_name TEXT NOT NULL, "
+        "day INTEGER NOT NULL, "
+        "sensor TEXT NOT NULL, "
+        "count INTEGER NOT NULL, "
+        "total REAL, "
+        "minimum REAL, "
+        "maximum REAL, "
+        "PRIMARY KEY (table_name, day, sensor))"
+    )
+
+
+def has_statistics(conn: sqlite3.Connection):
+    """ databases built before the statistics table do not have it """
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'STATISTICS'"
+    ).fetchone() is not None
+
+
+def statistics_digest(
+    conn: sqlite3.Connection, start_key: int = None, end_key: int = None
+):
+    """
+    digest of the statistics rows of the days of the window, every
+    written file changes count and sum of the days it touches
+    """
+    condition, params = day_range_condition(start_key, end_key)
+    digest = hashlib.blake2b(digest_size=16)
+    for row in conn.execute(
+        f"SELECT * FROM STATISTICS {condition}"
+        "ORDER BY table_name, day, sensor",
+        params
+    ):
+        digest.update(repr(row).encode())
+    return digest.hexdigest()
+
+
+def statistics_from_rows(rows: list):
+    """ (sensor, count, total, min, max) rows -> statistics dict """
+    statistics = dict()
+    for sensor_name, count, total, minimum, maximum in rows:
+        statistics[sensor_name] = {
+            'count': count,
+            'mean': total / count if count else float('nan'),
+            'min': minimum,
+            'max': maximum,
+        }
+    return statistics
+
+
+class DataStore(ABC):
+    """
+    base class of the storage backends, keeps recently used windows
+    and prefetches the neighbouring days in the background
+    """
+
+    def __init__(self, prefetch_days: int = 1, cached_windows: int = 8):
+        self.prefetch_days = prefetch_days
+        self.cached_windows = cached_windows
+        self.windows = OrderedDict()
+        self.in_flight = dict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def query_window(self, start_key: int, end_key: int):
+        """ read the window from the storage """
+        return TimeIndexedData(MapData(
+            data_obs=self.query_table("OBS", start_key, end_key),
+            data_bw=self.query_table("BW", start_key, end_key),
+            data_fw=self.query_table("FW", start_key, end_key),
+        ))
+
+    @abstractmethod
+    def query_table(self, table_name: str, start_key: int, end_key: int):
+        """ read the used columns of one table for the time range """
+
+    @abstractmethod
+    def sensor_statistics(self, start_key: int = None, end_key: int = None):
+        """ count, mean, min and max per sensor over all tables,
+        for the whole data or the days touched by the given window """
+
+    @abstractmethod
+    def content_digest(self, start_key: int = None, end_key: int = None):
+        """ changes whenever the stored data of the whole database or
+        of the days touched by the given window changes """
+
+    def get_window(self, start_key: int, end_key: int):
+        """
+        returns the data between both keys (inclusive), cut out of
+        a loaded or prefetched window covering the range when possible
+        """
+        window_key = (start_key, end_key)
+        with self.lock:
+            indexed_data = self.covering_window(start_key, end_key)
+            future = self.in_flight.get(window_key)
+
+        if indexed_data is None:
+            if future is not None:
+                indexed_data = future.result()
+            else:
+                indexed_data = self.query_window(start_key, end_key)
+                self.store_window(window_key, indexed_data)
+
+        self.prefetch(start_key, end_key)
+        return indexed_data.slice(start_key, end_key)
+
+    def covering_window(self, start_key: int, end_key: int):
+        """ the most recently used window containing the range,
+        the caller holds the lock """
+        for window_key in reversed(self.windows):
+            if window_key[0] <= start_key and end_key <= window_key[1]:
+                self.windows.move_to_end(window_key)
+                return self.windows[window_key]
+        return None
+
+    def store_window(self, window_key: tuple, indexed_data: TimeIndexedData):
+        """ keep a window, the least recently used ones are dropped """
+        with self.lock:
+            self.windows[window_key] = indexed_data
+            self.windows.move_to_end(window_key)
+            while len(self.windows) > self.cached_windows:
+                self.windows.popitem(last=False)
+
+    def prefetch(self, start_key: int, end_key: int):
+        """ load the days the previous and next buttons will ask for """
+        for days in range(1, self.prefetch_days + 1):
+            for offset in (days, -days):
+                window_key = (
+                    shift_key(start_key, offset), shift_key(end_key, offset)
+                )
+                with self.lock:
+                    if window_key in self.in_flight or self.covering_window(
+                        *window_key
+                    ) is not None:
+                        continue
+                    self.in_flight[window_key] = self.executor.submit(
+                        self.prefetch_window, window_key
+                    )
+
+    def prefetch_window(self, window_key: tuple):
+        """ runs in the background thread """
+        indexed_data = self.query_window(*window_key)
+        self.store_window(window_key, indexed_data)
+        with self.lock:
+            self.in_flight.pop(window_key, None)
+        return indexed_data
+
+    def close(self):
+        """ stop the prefetching """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SqliteDataStore(DataStore):
+    """ reads the time windows from the SQLite database on demand """
+
+    def __init__(self, database_path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.database_path = database_path
+        self.local = threading.local()
+        self.time_expressions = self.read_time_expressions()
+        # set once adding the statistics table failed, not retried
+        self.statistics_failed = False
+
+    def connection(self):
+        """ sqlite connections can not be shared between threads """
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(self.database_path)
+        return self.local.conn
+
+    def read_time_expressions(self):
+        """
+        databases built before the typed schema store the OBS time
+        as bytes, these are cast to the integer key in the query
+        """
+        time_expressions = dict()
+        for table_name, time_column in TIME_COLUMNS.items():
+            row = self.connection().execute(
+                f"SELECT typeof({time_column}) FROM {table_name} LIMIT 1"
+            ).fetchone()
+            if row is not None and row[0] == "blob":
+                time_expressions[table_name] = \
+                    f"CAST({time_column} AS INTEGER)"
+            else:
+                time_expressions[table_name] = time_column
+        return time_expressions
+
+    def query_table(self, table_name: str, start_key: int, end_key: int):
+        time_column = TIME_COLUMNS[table_name]
+        time_expression = self.time_expressions[table_name]
+        columns = ", ".join(
+            [f"{time_expression} AS {time_column}", "latitude", "longitude"]
+            + SENSOR_COLUMNS
+        )
+        return pd.read_sql_query(
+            f"SELECT {columns} FROM {table_name} "
+            f"WHERE {time_expression} BETWEEN ? AND ? "
+            f"ORDER BY {time_expression}",
+            self.connection(),
+            params=(start_key, end_key),
+            dtype=window_dtypes(table_name)
+        )
+
+    def fill_statistics(self):
+        """
+        databases built before the statistics table get it with one
+        grouped scan per table, False if the database can not be
+        written, then every start has to scan the tables again
+        """
+        if self.statistics_failed:
+            return False
+        conn = self.connection()
+        try:
+            # other processes opening the database wait for this one
+            conn.execute("BEGIN IMMEDIATE")
+            if not has_statistics(conn):
+                print("adding the statistics table to " + self.database_path)
+                create_statistics_table(conn)
+                for table_name in TIME_COLUMNS:
+                    self.insert_statistics(conn, table_name)
+            conn.commit()
+            return True
+        except sqlite3.OperationalError as error:
+            conn.rollback()
+            self.statistics_failed = True
+            print(
+                f"could not add the statistics table to "
+                f"{self.database_path} ({error}), the tables are scanned "
+                f"on every start until it is rebuilt with "
+                f"database_builder.py"
+            )
+            return False
+
+    def insert_statistics(self, conn: sqlite3.Connection, table_name: str):
+        """ the statistics rows of one table, grouped by day """
+        aggregates = ", ".join(
+            f"COUNT({sensor_name}), SUM({sensor_name}), "
+            f"MIN({sensor_name}), MAX({sensor_name})"
+            for sensor_name in SENSOR_COLUMNS
+        )
+        rows = list()
+        for day, *values in conn.execute(
+            f"SELECT {self.time_expressions[table_name]} / 10000 AS day, "
+            f"{aggregates} FROM {table_name} GROUP BY day"
+        ):
+            for i, sensor_name in enumerate(SENSOR_COLUMNS):
+                rows.append(
+                    (table_name, day, sensor_name, *values[4 * i:4 * i + 4])
+                )
+        conn.executemany(
+            "INSERT INTO STATISTICS VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+
+    def content_digest(self, start_key: int = None, end_key: int = None):
+        conn = self.connection()
+        if has_statistics(conn) or self.fill_statistics():
+            return statistics_digest(conn, start_key, end_key)
+        # older databases, any change of the file counts
+        stat = os.stat(self.database_path)
+        return hashlib.blake2b(
+            f"{stat.st_size} {stat.st_mtime_ns}".encode(), digest_size=16
+        ).hexdigest()
+
+    def sensor_statistics(self, start_key: int = None, end_key: int = None):
+        conn = self.connection()
+        if has_statistics(conn) or self.fill_statistics():
+            return read_statistics(conn, start_key, end_key)
+
+        # read-only older databases, aggregate in sqlite instead of pandas
+        rows = list()
+        for sensor_name in SENSOR_COLUMNS:
+            parts = list()
+            for table_name in TIME_COLUMNS:
+                time_expression = self.time_expressions[table_name]
+                condition, params = "", ()
+                if start_key is not None:
+                    condition = f"WHERE {time_expression} BETWEEN ? AND ?"
+                    params = (
+                        start_key // 10000 * 10000,
+                        end_key // 10000 * 10000 + 2359
+                    )
+                parts.append(conn.execute(
+                    f"SELECT COUNT({sensor_name}), SUM({sensor_name}), "
+                    f"MIN({sensor_name}), MAX({sensor_name}) "
+                    f"FROM {table_name} {condition}",
+                    params
+                ).fetchone())
+            minimums = [part[2] for part in parts if part[2] is not None]
+            maximums = [part[3] for part in parts if part[3] is not None]
+            rows.append((
+                sensor_name,
+                sum(part[0] for part in parts),
+                sum(part[1] or 0.0 for part in parts),
+                min(minimums) if minimums else None,
+                max(maximums) if maximums else None,
+            ))
+        return statistics_from_rows(rows)
+
+
+class ColumnarDataStore(DataStore):
+    """
+    reads the day partitions written by the builder in the Parquet or
+    Arrow IPC format, the files are memory mapped and only the used
+    columns are read
+    """
+
+    def __init__(self, root: str, file_format: str = "parquet", **kwargs):
+        if file_format not in COLUMNAR_FORMATS:
+            raise ValueError(f"unknown columnar format {file_format}")
+        if pa is None:
+            raise ImportError("the columnar backends need pyarrow")
+        super().__init__(**kwargs)
+        self.root = root
+        self.file_format = file_format
+        self.local = threading.local()
+
+    def connection(self):
+        """ the catalog holds the statistics table """
+        if not hasattr(self.local, "conn"):
+            self.local.conn = sqlite3.connect(
+                os.path.join(self.root, CATALOG_FILE_NAME)
+            )
+        return self.local.conn
+
+    def read_part(self, path: str, columns: list):
+        """ memory mapped read of one part file """
+        if self.file_format == "parquet":
+            return pq.read_table(path, columns=columns, memory_map=True)
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).read_all().select(columns)
+
+    def query_table(self, table_name: str, start_key: int, end_key: int):
+        time_column = TIME_COLUMNS[table_name]
+        columns = [time_column, "latitude", "longitude"] + SENSOR_COLUMNS
+
+        tables = list()
+        day = key_to_datetime(start_key).date()
+        while day <= key_to_datetime(end_key).date():
+            directory = os.path.join(
+                self.root, table_name, day.strftime("%Y%m%d")
+            )
+            if os.path.isdir(directory):
+                for part_name in sorted(os.listdir(directory)):
+                    if part_name.endswith("." + self.file_format):
+                        tables.append(self.read_part(
+                            os.path.join(directory, part_name), columns
+                        ))
+            day += timedelta(days=1)
+
+        if not tables:
+            return pd.DataFrame({
+                column: pd.Series(dtype=dtype)
+                for column, dtype in window_dtypes(table_name).items()
+            })
+        table = pa.concat_tables(tables)
+        times = table.column(time_column)
+        table = table.filter(pc.and_(
+            pc.greater_equal(times, start_key),
+            pc.less_equal(times, end_key)
+        ))
+        return table.to_pandas()
+
+    def content_digest(self, start_key: int = None, end_key: int = None):
+        return statistics_digest(self.connection(), start_key, end_key)
+
+    def sensor_statistics(self, start_key: int = None, end_key: int = None):
+        return read_statistics(self.connection(), start_key, end_key)
+
+
+class MemoryDataStore(SqliteDataStore):
+    """
+    loads the whole SQLite database once and keeps it sorted by time,
+    every window is a binary searched slice of the loaded frames
+    """
+
+    def __init__(self, database_path: str, **kwargs):
+        # everything is loaded, there is nothing to prefetch
+        kwargs['prefetch_days'] = 0
+        super().__init__(database_path, **kwargs)
+        self.indexed_data = self.query_window(0, 999999999999)
+
+    def get_window(self, start_key: int, end_key: int):
+        return self.indexed_data.slice(start_key, end_key)
+
+
+def open_data_store(backend: str, path: str, **kwargs):
+    """
+    the data store for the configured backend, "sqlite" reads the
+    database file window by window, "memory" loads it completely,
+    "parquet" and "arrow" read the directory of day partitions
+    """
+    if backend == "sqlite":
+        return SqliteDataStore(path, **kwargs)
+    if backend == "memory":
+        return MemoryDataStore(path, **kwargs)
+    return ColumnarDataStore(path, backend, **kwargs)
@@ -1,80 +1,551 @@
 """ little script to download the data """
-import time
+import argparse
+import os
 import sqlite3 as sql
+import time
+from abc import ABC, abstractmethod
+
 import xarray as xr
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # only needed for the columnar formats
+    pa = None
+
+from data_access import (
+    SENSOR_COLUMNS,
+    TIME_COLUMNS,
+    COLUMNAR_FORMATS,
+    CATALOG_FILE_NAME,
+    create_statistics_table
+)
+from worker_pool import bounded_map, worker_state
 
+EXTRAPOLATED_TABLES = ["BW", "FW"]
+OBS_FILE_NAME = "obs_2013.nc"
+OPENDAP_URL = "https://opendap.hereon.de/opendap/data/cosyna/synopsis/"
 
-def write_into_database():
-    """ connect to db """
+
+def june_2013_file_names():
+    """ names of the hourly files of june 2013 """
     list_file_names = list()
     for i in range(1, 31):
         for j in range(0, 24):
             list_file_names.append(f"synop_201306{i:02d}{j:02d}.nc")
-    conn = sql.connect("data/data_test2.db")
-    df = xr.open_dataset(
-        "https://opendap.hereon.de/opendap/data/cosyna/synopsis/OBS/obs_2013.nc"
+    return list_file_names
+
+
+def file_name_to_time(file_name: str):
+    """ synop_2013060100.nc -> 201306010000 """
+    return int(file_name[6:-3]) * 100
+
+
+class DataSource(ABC):
+    """ base class for the places the NetCDF files are read from """
+
+    @abstractmethod
+    def obs_path(self):
+        """ location of the observation file """
+
+    @abstractmethod
+    def file_path(self, table_name: str, file_name: str):
+        """ location of an hourly file for the given target table """
+
+    @abstractmethod
+    def file_names(self):
+        """ names of all hourly files """
+
+    def open(self, path: str):
+        """ decode a NetCDF file into a dataframe """
+        with xr.open_dataset(path) as dataset:
+            return dataset.to_dataframe()
+
+
+class OpendapSource(DataSource):
+    """ the remote OPeNDAP server the data originally comes from """
+
+    # BW and FW have always been built from the BW files
+    table_dirs = {
+        "BW": "synopsis_BW/BW_2013_06/",
+        "FW": "synopsis_BW/BW_2013_06/",
+    }
+
+    def __init__(self, base_url: str = OPENDAP_URL):
+        self.base_url = base_url
+
+    def obs_path(self):
+        return self.base_url + "OBS/" + OBS_FILE_NAME
+
+    def file_path(self, table_name: str, file_name: str):
+        return self.base_url + self.table_dirs[table_name] + file_name
+
+    def file_names(self):
+        return june_2013_file_names()
+
+
+class LocalDirectorySource(DataSource):
+    """
+    a local copy of the data, laid out as
+    <directory>/obs_2013.nc and <directory>/<table>/synop_*.nc
+    """
+
+    def __init__(self, directory: str, table_dirs: dict = None):
+        self.directory = directory
+        self.table_dirs = table_dirs or {
+            table_name: table_name for table_name in EXTRAPOLATED_TABLES
+        }
+
+    def obs_path(self):
+        return os.path.join(self.directory, OBS_FILE_NAME)
+
+    def file_path(self, table_name: str, file_name: str):
+        return os.path.join(
+            self.directory, self.table_dirs[table_name], file_name
+        )
+
+    def file_names(self):
+        file_names = set()
+        for table_dir in set(self.table_dirs.values()):
+            file_names.update(
+                file_name
+                for file_name in os.listdir(
+                    os.path.join(self.directory, table_dir)
+                )
+                if file_name.startswith("synop_")
+                and file_name.endswith(".nc")
+            )
+        return sorted(file_names)
+
+
+def setup_worker(source: DataSource, label_index: pd.DataFrame):
+    """ give every worker process the source and the label index once """
+    return {'source': source, 'label_index': label_index}
+
+
+def decode_file(file_name: str, table_names: list):
+    """
+    decode one hourly file for the given target tables,
+    every source file is only read once even if several tables use it
+    """
+    source = worker_state()['source']
+    decoded = dict()
+    frames = dict()
+    for table_name in table_names:
+        path = source.file_path(table_name, file_name)
+        if path not in decoded:
+            df = source.open(path)
+            df['initial_time'] = file_name_to_time(file_name)
+            process_extrapolated_data(
+                df, label_index=worker_state()['label_index']
+            )
+            decoded[path] = df
+        frames[table_name] = decoded[path]
+    return file_name, frames
+
+
+DATA_COLUMNS = ["label", "latitude", "longitude"] + SENSOR_COLUMNS
+COLUMN_TYPES = {"label": "TEXT", "latitude": "REAL", "longitude": "REAL"} | {
+    sensor_name: "REAL" for sensor_name in SENSOR_COLUMNS
+}
+
+
+def table_columns(table_name: str):
+    """ the columns stored for a table, the time column comes first """
+    return [TIME_COLUMNS[table_name]] + DATA_COLUMNS
+
+
+def decode_bytes(values: pd.Series):
+    """ the NetCDF char arrays arrive as bytes, store them as text """
+    if len(values.index) and isinstance(values.iloc[0], bytes):
+        return values.str.decode('utf-8').str.strip()
+    return values
+
+
+def time_key(values: pd.Series):
+    """ convert times like b'201306010000' or datetimes
+    into the integer key 201306010000 """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.dt.strftime('%Y%m%d%H%M').astype('int64')
+    return pd.to_numeric(decode_bytes(values)).astype('int64')
+
+
+def table_rows(table_name: str, df: pd.DataFrame):
+    """ bring a decoded frame into the column layout of the table """
+    time_column = TIME_COLUMNS[table_name]
+    rows = pd.DataFrame({
+        time_column: time_key(df[time_column]),
+        'label': decode_bytes(df['label']),
+    })
+    for column in DATA_COLUMNS[1:]:
+        rows[column] = df[column].astype('float64')
+    return rows
+
+
+def create_catalog(conn: sql.Connection):
+    """
+    the manifest records every file that is completely written,
+    the statistics hold count, sum, min and max per table, day and
+    sensor so the app can get the statistics of any time window
+    (and the global ones) from a few rows instead of scanning the data
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS MANIFEST ("
+        "file_name TEXT NOT NULL, "
+        "table_name TEXT NOT NULL, "
+        "rows INTEGER NOT NULL, "
+        "PRIMARY KEY (file_name, table_name))"
+    )
+    create_statistics_table(conn)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS LABELS (label PRIMARY KEY, "
+        + ", ".join(f"{sensor_name} REAL" for sensor_name in SENSOR_COLUMNS)
+        + ")"
+    )
+    conn.commit()
+
+
+def record_label_index(conn: sql.Connection, label_index: pd.DataFrame):
+    """ keep the label index of the OBS file so a resumed build does
+    not decode the file again, the labels keep their type """
+    placeholders = ", ".join("?" * (1 + len(SENSOR_COLUMNS)))
+    conn.execute("DELETE FROM LABELS")
+    conn.executemany(
+        f"INSERT INTO LABELS VALUES ({placeholders})",
+        label_index.reset_index().itertuples(index=False, name=None)
+    )
+
+
+def read_label_index(conn: sql.Connection):
+    """ the recorded label index, None if there is none """
+    label_index = pd.read_sql_query(
+        "SELECT * FROM LABELS", conn,
+        dtype={sensor_name: 'float64' for sensor_name in SENSOR_COLUMNS}
+    )
+    if label_index.empty:
+        return None
+    return label_index.set_index('label')[SENSOR_COLUMNS]
+
+
+def read_manifest(conn: sql.Connection):
+    """ set of the (file_name, table_name) pairs already written """
+    return set(conn.execute("SELECT file_name, table_name FROM MANIFEST"))
+
+
+def record_file(
+    conn: sql.Connection, file_name: str, table_name: str,
+    rows: pd.DataFrame
+):
+    """ add a written file to the manifest and its rows to the statistics,
+    the caller commits both together with the data """
+    conn.execute(
+        "INSERT OR REPLACE INTO MANIFEST VALUES (?, ?, ?)",
+        (file_name, table_name, len(rows.index))
     )
-    df = df.to_dataframe()
-    df.to_sql("OBS", conn, if_exists='append')
-    for i, file_name in enumerate(list_file_names):
-        df1 = xr.open_dataset(
-            "https://opendap.hereon.de/opendap/data/cosyna/synopsis/synopsis_BW/BW_2013_06/"
-            + file_name
+    days = rows[TIME_COLUMNS[table_name]] // 10000
+    sensors = rows[SENSOR_COLUMNS].groupby(days)
+    aggregates = {
+        'count': sensors.count(),
+        'total': sensors.sum(),
+        'minimum': sensors.min(),
+        'maximum': sensors.max(),
+    }
+    conn.executemany(
+        "INSERT INTO STATISTICS VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (table_name, day, sensor) DO UPDATE SET "
+        "count = count + excluded.count, "
+        "total = coalesce(total, 0) + coalesce(excluded.total, 0), "
+        "minimum = min(coalesce(minimum, excluded.minimum), "
+        "coalesce(excluded.minimum, minimum)), "
+        "maximum = max(coalesce(maximum, excluded.maximum), "
+        "coalesce(excluded.maximum, maximum))",
+        [
+            (
+                table_name, int(day), sensor_name,
+                int(aggregates['count'].at[day, sensor_name]),
+                float(aggregates['total'].at[day, sensor_name]),
+                none_if_nan(aggregates['minimum'].at[day, sensor_name]),
+                none_if_nan(aggregates['maximum'].at[day, sensor_name]),
             )
-        df1 = df1.to_dataframe()
-        df1['initial_time'] = int(file_name[6:-3]) * 100
-        process_extrapolated_data(df1, df)
-        df1.to_sql("BW", conn, if_exists='append')
-
-        df2 = xr.open_dataset(
-            "https://opendap.hereon.de/opendap/data/cosyna/synopsis/synopsis_BW/BW_2013_06/"
-            + file_name
+            for day in aggregates['count'].index
+            for sensor_name in SENSOR_COLUMNS
+        ]
+    )
+
+
+def none_if_nan(value: float):
+    """ sqlite NULL for missing values """
+    return None if pd.isna(value) else float(value)
+
+
+class SqliteWriter:
+    """
+    the single writer of the build, rows are inserted with executemany
+    in large transactions and the indexes are created at the end
+    """
+
+    def __init__(self, database_path: str, batch_rows: int = 200000):
+        self.conn = sql.connect(database_path)
+        self.batch_rows = batch_rows
+        self.pending_rows = 0
+        # the build can be repeated if it crashes, so durability
+        # is traded for insert speed
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.create_schema()
+        create_catalog(self.conn)
+
+    def create_schema(self):
+        """ typed tables for the data """
+        for table_name, time_column in TIME_COLUMNS.items():
+            columns = ", ".join(
+                [f"{time_column} INTEGER NOT NULL"]
+                + [f"{column} {COLUMN_TYPES[column]}"
+                   for column in DATA_COLUMNS]
+            )
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table_name} ({columns})"
+            )
+        self.conn.commit()
+
+    def create_indexes(self):
+        """ indexes for time range, label and position queries """
+        for table_name, time_column in TIME_COLUMNS.items():
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table_name}_time "
+                f"ON {table_name} ({time_column})"
+            )
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table_name}_label "
+                f"ON {table_name} (label, {time_column})"
+            )
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_{table_name}_lat_lon "
+                f"ON {table_name} (latitude, longitude)"
             )
-        df2 = df2.to_dataframe()
-        df2['initial_time'] = int(file_name[6:-3]) * 100
-        process_extrapolated_data(df2, df)
-        df2.to_sql("FW", conn, if_exists='append')
-
-        print(int(file_name[6:-3]) * 100)
-
-
-def process_extrapolated_data(df_ext: pd.DataFrame, df_obs: pd.DataFrame):
-    """ processing the data """
-    sen_list = [[] for _ in range(7)]  # [], [], [], [], [], [], []]
-    for _, row in df_ext.iterrows():
-        id_row = row['label']
-        mask = df_obs['label'].values == id_row
-
-        sen1 = df_obs[mask]['sensor_1'].values[0]
-        sen2 = df_obs[mask]['sensor_2'].values[0]
-        sen3 = df_obs[mask]['sensor_3'].values[0]
-        sen4 = df_obs[mask]['sensor_4'].values[0]
-        sen5 = df_obs[mask]['sensor_5'].values[0]
-        sen6 = df_obs[mask]['sensor_6'].values[0]
-        sen7 = df_obs[mask]['sensor_7'].values[0]
-
-        sen_list[0].append(sen1)
-        sen_list[1].append(sen2)
-        sen_list[2].append(sen3)
-        sen_list[3].append(sen4)
-        sen_list[4].append(sen5)
-        sen_list[5].append(sen6)
-        sen_list[6].append(sen7)
-
-    df_ext['sensor_1'] = sen_list[0]
-    df_ext['sensor_2'] = sen_list[1]
-    df_ext['sensor_3'] = sen_list[2]
-    df_ext['sensor_4'] = sen_list[3]
-    df_ext['sensor_5'] = sen_list[4]
-    df_ext['sensor_6'] = sen_list[5]
-    df_ext['sensor_7'] = sen_list[6]
+        self.conn.commit()
+
+    def done(self):
+        """ set of the (file_name, table_name) pairs already written """
+        return read_manifest(self.conn)
+
+    def write(self, file_name: str, frames: dict):
+        """
+        insert the frames of one file, the manifest entry is part of
+        the same savepoint so a file is either complete or missing,
+        also when the build stops while it is written
+        """
+        self.conn.execute("SAVEPOINT write_file")
+        try:
+            for table_name, df in frames.items():
+                rows = table_rows(table_name, df)
+                columns = table_columns(table_name)
+                self.conn.executemany(
+                    f"INSERT INTO {table_name} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})",
+                    rows.itertuples(index=False, name=None)
+                )
+                record_file(self.conn, file_name, table_name, rows)
+                self.pending_rows += len(rows.index)
+        except BaseException:
+            self.conn.execute("ROLLBACK TO write_file")
+            raise
+        finally:
+            self.conn.execute("RELEASE write_file")
+        if self.pending_rows >= self.batch_rows:
+            self.commit()
+
+    def commit(self):
+        """ end the current transaction """
+        self.conn.commit()
+        self.pending_rows = 0
+
+    def close(self):
+        """ finish the build, the database is left as a single file """
+        self.commit()
+        self.create_indexes()
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.close()
+
+
+class ColumnarWriter:
+    """
+    writes the tables as Parquet or Arrow IPC files partitioned by day,
+    <root>/<table>/<YYYYMMDD>/<source file>.<format>,
+    manifest and statistics are kept in <root>/catalog.db
+    """
+
+    def __init__(self, root: str, file_format: str = "parquet"):
+        if file_format not in COLUMNAR_FORMATS:
+            raise ValueError(f"unknown columnar format {file_format}")
+        if pa is None:
+            raise ImportError("the columnar formats need pyarrow")
+        self.root = root
+        self.file_format = file_format
+        os.makedirs(root, exist_ok=True)
+        self.conn = sql.connect(os.path.join(root, CATALOG_FILE_NAME))
+        create_catalog(self.conn)
+
+    def done(self):
+        """ set of the (file_name, table_name) pairs already written """
+        return read_manifest(self.conn)
+
+    def write(self, file_name: str, frames: dict):
+        """
+        write the frames of one file, a part file is moved into place
+        only once it is complete so reruns simply overwrite it
+        """
+        part_name = file_name[:-len(".nc")] + "." + self.file_format
+        for table_name, df in frames.items():
+            rows = table_rows(table_name, df)
+            days = rows[TIME_COLUMNS[table_name]] // 10000
+            for day, day_rows in rows.groupby(days):
+                directory = os.path.join(self.root, table_name, str(day))
+                os.makedirs(directory, exist_ok=True)
+                self.write_part(
+                    day_rows, os.path.join(directory, part_name)
+                )
+            record_file(self.conn, file_name, table_name, rows)
+        self.commit()
+
+    def write_part(self, rows: pd.DataFrame, path: str):
+        """ write one part file atomically """
+        table = pa.Table.from_pandas(rows, preserve_index=False)
+        temp_path = path + ".tmp"
+        if self.file_format == "parquet":
+            pq.write_table(table, temp_path)
+        else:
+            with pa.OSFile(temp_path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as ipc_writer:
+                    ipc_writer.write_table(table)
+        os.replace(temp_path, path)
+
+    def commit(self):
+        """ end the current transaction of the catalog """
+        self.conn.commit()
+
+    def close(self):
+        """ finish the build """
+        self.commit()
+        self.conn.close()
+
+
+def create_writer(output: str, output_format: str = "sqlite"):
+    """ the writer for the chosen storage backend """
+    if output_format == "sqlite":
+        return SqliteWriter(output)
+    return ColumnarWriter(output, output_format)
+
+
+def write_into_database(
+    source: DataSource = None,
+    database_path: str = "data/data_test2.db",
+    workers: int = None,
+    output_format: str = "sqlite"
+):
+    """
+    decode the files in a process pool and write them with a single writer,
+    files already in the manifest are skipped so the build can be resumed,
+    for the columnar formats database_path is the output directory
+    """
+    source = source or OpendapSource()
+    writer = create_writer(database_path, output_format)
+    done = writer.done()
+
+    # a resumed build takes the labels of the OBS file from the catalog
+    label_index = None
+    if (OBS_FILE_NAME, "OBS") in done:
+        label_index = read_label_index(writer.conn)
+    if label_index is None:
+        df = source.open(source.obs_path())
+        if (OBS_FILE_NAME, "OBS") not in done:
+            writer.write(OBS_FILE_NAME, {"OBS": df})
+        label_index = build_label_index(df)
+        record_label_index(writer.conn, label_index)
+        writer.commit()
+
+    pending = list()
+    for file_name in source.file_names():
+        table_names = [
+            table_name for table_name in EXTRAPOLATED_TABLES
+            if (file_name, table_name) not in done
+        ]
+        if table_names:
+            pending.append((file_name, table_names))
+    print(f"{len(pending)} files to process")
+
+    try:
+        for file_name, frames in bounded_map(
+            decode_file, pending, setup_worker, (source, label_index), workers
+        ):
+            writer.write(file_name, frames)
+            print(file_name_to_time(file_name))
+    except BaseException:
+        # a failed or interrupted build keeps the files written so far,
+        # the next run resumes after them
+        writer.commit()
+        writer.conn.close()
+        raise
+
+    writer.close()
+
+
+def build_label_index(df_obs: pd.DataFrame):
+    """ build the label -> sensor lookup table once,
+    the first observation of a label wins """
+    label_index = df_obs.drop_duplicates('label', keep='first')
+    return label_index.set_index('label')[SENSOR_COLUMNS]
+
+
+def process_extrapolated_data(
+    df_ext: pd.DataFrame,
+    df_obs: pd.DataFrame = None,
+    label_index: pd.DataFrame = None
+):
+    """ processing the data, copies the sensor values of the
+    observation with the same label into the extrapolated data """
+    if label_index is None:
+        label_index = build_label_index(df_obs)
+    sensor_values = label_index.reindex(df_ext['label'].values).to_numpy()
+    for i, sensor_name in enumerate(SENSOR_COLUMNS):
+        df_ext[sensor_name] = sensor_values[:, i]
+
+
+def parse_args():
+    """ command line options of the builder """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--source-dir",
+        help="read the NetCDF files from a local directory "
+             "instead of the OPeNDAP server"
+    )
+    parser.add_argument(
+        "--database", default="data/data_test2.db",
+        help="SQLite database to write into, or the output directory "
+             "for the columnar formats"
+    )
+    parser.add_argument(
+        "--format", default="sqlite", choices=["sqlite", *COLUMNAR_FORMATS],
+        help="storage backend, the columnar formats write one file "
+             "per source file and day"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None,
+        help="number of decoding processes, defaults to the cpu count"
+    )
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = parse_args()
     print("started building db...")
     start_time = time.time()
-    write_into_database()
+    write_into_database(
+        LocalDirectorySource(args.source_dir) if args.source_dir else None,
+        args.database,
+        args.workers,
+        args.format
+    )
     print("building db done in "
             + str(int((time.time() - start_time) / 60))
             + " minutes and "
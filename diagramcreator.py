@@ -2,70 +2,143 @@
 Central File for the interactive diagram
 """
 
-import plotly.graph_objects as go
-import pandas as pd
-
+import json
+import os
 
-def save_diagram_file(
-    m_data,
-    global_data,
-    salinity_value
-):
-    """ save the interactive file into html """
+import numpy
+import plotly
+import plotly.graph_objects as go
 
-    merged_data = pd.concat([
-        m_data.data_obs,
-        m_data.data_bw,
-        m_data.data_fw
+from data_access import SENSOR_COLUMNS
+
+# the radar page loads the plotly bundle shipped with the package
+PLOTLY_JS_DIR = os.path.join(os.path.dirname(plotly.__file__), "package_data")
+RADAR_DIV_ID = "radarplot"
+SENSOR_NAMES = {
+    "sensor_1": "Salinity",
+    "sensor_2": "Temperature",
+    "sensor_3": "CDOM",
+    "sensor_4": "Chlorophyll",
+    "sensor_5": "DO",
+    "sensor_6": "DOSat",
+    "sensor_7": "DO_Anomaly",
+}
+# order of the traces, every update replaces their r arrays
+RADAR_TRACES = ['max_above', 'max_below', 'min_above', 'min_below']
+
+
+def radar_normalisation(sensor_statistics: dict):
+    """ global min, max and mean per sensor used to normalise the
+    radar plot, taken from the statistics table of the database """
+    global_data = dict()
+    for sensor_name, statistics in sensor_statistics.items():
+        # a sensor without any value has no min and max, its
+        # values on the radar plot are left out
+        minimum, maximum = statistics['min'], statistics['max']
+        global_data[sensor_name] = {
+            'max': numpy.nan if maximum is None else maximum,
+            'min': numpy.nan if minimum is None else max(0, minimum),
+            'mean': statistics['mean'],
+        }
+    return global_data
+
+
+def sensor_block(m_data):
+    """ the sensors of all three tables as one contiguous
+    (sensors, rows) array, every sensor is a contiguous row
+    and salinity is the first one """
+    frames = (m_data.data_obs, m_data.data_bw, m_data.data_fw)
+    return numpy.stack([
+        numpy.concatenate([df[cat].to_numpy(dtype=float) for df in frames])
+        for cat in SENSOR_COLUMNS
     ])
 
-    merge_data_below_sal = merged_data[
-        merged_data["sensor_1"] <= salinity_value
-    ]
-    merge_data_above_sal = merged_data[
-        merged_data["sensor_1"] > salinity_value
-    ]
-
-    pandas_col_to_sensor_data_name = {
-        "sensor_1": "Salinity",
-        "sensor_2": "Temperature",
-        "sensor_3": "CDOM",
-        "sensor_4": "Chlorophyll",
-        "sensor_5": "DO",
-        "sensor_6": "DOSat",
-        "sensor_7": "DO_Anomaly",
-    }
-
-    categories = [
-        pandas_col_to_sensor_data_name[f'sensor_{i}']
-        for i in range(1, 8)
-    ]
-
-    data_max_above = list()
-    data_min_above = list()
-
-    data_max_below = list()
-    data_min_below = list()
-
-    # gets min and max value for all data
-    for i in range(1, 8):
-        cat = f'sensor_{i}'
-
-        global_min = global_data[cat]['min']
-        global_max = global_data[cat]['max']
-
-        current_max_above = merge_data_above_sal[cat].max()
-        current_min_above = merge_data_above_sal[cat].min()
 
-        data_max_above.append((current_max_above - global_min) / global_max)
-        data_min_above.append((current_min_above - global_min) / global_max)
-
-        current_max_below = merge_data_below_sal[cat].max()
-        current_min_below = merge_data_below_sal[cat].min()
-
-        # we normalise the values
-        data_max_below.append((current_max_below - global_min) / global_max)
-        data_min_below.append((current_min_below - global_min) / global_max)
+def missing_to_nan(values: numpy.ndarray):
+    """ the reduction of an empty side gives +-inf, pandas gives NaN """
+    values[numpy.isinf(values)] = numpy.nan
+    return values
+
+
+def threshold_extremes(block: numpy.ndarray, salinity_value: float):
+    """
+    min and max per sensor below (inclusive) and above the threshold,
+    the rows of the other side are masked in the reduction instead of
+    copied, missing values are skipped and an empty side is NaN like
+    in pandas
+    """
+    salinity = block[0]
+    extremes = dict()
+    for side, selected in (
+        ('below', salinity <= salinity_value),
+        ('above', salinity > salinity_value)
+    ):
+        extremes['max_' + side] = missing_to_nan(numpy.fmax.reduce(
+            block, axis=1, where=selected, initial=-numpy.inf
+        ))
+        extremes['min_' + side] = missing_to_nan(numpy.fmin.reduce(
+            block, axis=1, where=selected, initial=numpy.inf
+        ))
+    return extremes
+
+
+class SortedExtremes:
+    """
+    the rows sorted by salinity with running min and max per sensor
+    from both ends, the extremes for any threshold are one binary
+    search away, built once per time window
+    """
+
+    def __init__(self, block: numpy.ndarray):
+        block = block[:, ~numpy.isnan(block[0])]
+        block = block[:, numpy.argsort(block[0])]
+        self.salinity = block[0].copy()
+        # prefix[:, k] covers the rows up to k, suffix[:, k] those from k
+        self.prefix_max = numpy.fmax.accumulate(block, axis=1)
+        self.prefix_min = numpy.fmin.accumulate(block, axis=1)
+        self.suffix_max = numpy.fmax.accumulate(
+            block[:, ::-1], axis=1)[:, ::-1]
+        self.suffix_min = numpy.fmin.accumulate(
+            block[:, ::-1], axis=1)[:, ::-1]
+
+    def extremes(self, salinity_value: float):
+        """ the same as threshold_extremes of the unsorted block """
+        split = numpy.searchsorted(self.salinity, salinity_value, 'right')
+        missing = numpy.full(len(self.prefix_max), numpy.nan)
+        below = split > 0
+        above = split < len(self.salinity)
+        return {
+            'max_above': self.suffix_max[:, split] if above else missing,
+            'min_above': self.suffix_min[:, split] if above else missing,
+            'max_below': self.prefix_max[:, split - 1] if below else missing,
+            'min_below': self.prefix_min[:, split - 1] if below else missing,
+        }
+
+
+def radar_values(extremes: dict, global_data: dict):
+    """ the r arrays of the traces, normalised with the global
+    statistics, missing values become None """
+    global_min = numpy.array(
+        [global_data[cat]['min'] for cat in SENSOR_COLUMNS], dtype=float
+    )
+    global_max = numpy.array(
+        [global_data[cat]['max'] for cat in SENSOR_COLUMNS], dtype=float
+    )
+    values = list()
+    for name in RADAR_TRACES:
+        normalised = (extremes[name] - global_min) / global_max
+        values.append([
+            None if numpy.isnan(value) else float(value)
+            for value in normalised
+        ])
+    return values
+
+
+def radar_figure(values: list = None):
+    """ the radar plot with the four traces, empty without values """
+    categories = [SENSOR_NAMES[cat] for cat in SENSOR_COLUMNS]
+    values = values or [[None] * len(categories)] * len(RADAR_TRACES)
+    data_max_above, data_max_below, data_min_above, data_min_below = values
 
     fig = go.Figure()
 
@@ -120,7 +193,53 @@ def save_diagram_file(
       ),
       showlegend=True
     )
-    fig.write_html(
-        'radarplot.html',
+    return fig
+
+
+def radar_page_html():
+    """
+    the radar panel, loaded once with PLOTLY_JS_DIR as base url,
+    updates only replace the r arrays through updateRadar
+    """
+    html = radar_figure().to_html(
+        include_plotlyjs=False,
+        full_html=True,
+        div_id=RADAR_DIV_ID,
+        config={'responsive': True}
+    )
+    bridge = (
+        '<script src="plotly.min.js"></script>\n'
+        '<script>\n'
+        'window.updateRadar = function (values) {\n'
+        f'  var plot = document.getElementById("{RADAR_DIV_ID}");\n'
+        '  values.forEach(function (r, i) { plot.data[i].r = r; });\n'
+        '  Plotly.react(plot, plot.data, plot.layout);\n'
+        '};\n'
+        '</script>\n'
+    )
+    return html.replace("<head>", "<head>\n" + bridge, 1)
+
+
+def radar_update_script(values: list):
+    """ the javascript replacing the r arrays of the loaded page """
+    return f"updateRadar({json.dumps(values)});"
+
+
+def save_diagram_file(
+    m_data,
+    global_data,
+    salinity_value,
+    extremes: dict = None,
+    path: str = 'radarplot.html',
+    include_plotlyjs=True
+):
+    """ save the interactive file into html, the extremes of a
+    SortedExtremes of the window are used when given,
+    include_plotlyjs as for plotly's write_html """
+    if extremes is None:
+        extremes = threshold_extremes(sensor_block(m_data), salinity_value)
+    radar_figure(radar_values(extremes, global_data)).write_html(
+        path,
         auto_open=False,
+        include_plotlyjs=include_plotlyjs
     )
@@ -0,0 +1,236 @@
+"""
+Timing of the stages of the update pipeline, the metrics collected
+over many updates and an opt-in profiling of single updates
+"""
+import cProfile
+import csv
+import itertools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_MODES = ["cprofile", "tracemalloc"]
+# upper bounds of the histogram buckets in milliseconds, the last
+# bucket takes everything slower
+HISTOGRAM_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+# lines of the allocation report of a tracemalloc capture
+TRACEMALLOC_TOP = 25
+
+
+def memory_bytes():
+    """ the traced python allocations while tracemalloc runs, else the
+    resident set of the process, 0 where neither is available """
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class StageTimer:
+    """ collects the wall clock time of the named stages of one update
+    and how much the memory grew during them """
+
+    def __init__(self):
+        self.timings = dict()
+        self.memory = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        """ time the enclosed block, repeated stages are summed up """
+        start_memory = memory_bytes()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) \
+                + time.perf_counter() - start_time
+            self.memory[name] = self.memory.get(name, 0) \
+                + memory_bytes() - start_memory
+
+    def summary(self):
+        """ one line with the time of every stage in milliseconds """
+        return ", ".join(
+            f"{name} {seconds * 1000:.0f} ms"
+            for name, seconds in self.timings.items()
+        )
+
+
+class StageStatistics:
+    """ count, time histogram and memory growth of one stage """
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS_MS) + 1)
+        self.total_memory = 0
+        self.max_memory = 0
+
+    def add(self, seconds: float, memory: int = 0):
+        """ one more run of the stage """
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS_MS) \
+                and seconds * 1000 > HISTOGRAM_BOUNDS_MS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+        self.total_memory += memory
+        self.max_memory = max(self.max_memory, memory)
+
+    def percentile(self, fraction: float):
+        """ upper bucket bound in ms below which the fraction of the runs
+        stayed, None if it is in the open last bucket """
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS_MS, self.histogram):
+            seen += count
+            if seen >= needed:
+                return bound
+        return None
+
+    def row(self, name: str):
+        """ flat dict for the csv and json export """
+        row = {
+            'stage': name,
+            'count': self.count,
+            'total_ms': self.total_seconds * 1000,
+            'mean_ms': self.total_seconds * 1000 / max(self.count, 1),
+            'max_ms': self.max_seconds * 1000,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'mean_memory_bytes': self.total_memory / max(self.count, 1),
+            'max_memory_bytes': self.max_memory,
+        }
+        bounds = [f"le_{bound}ms" for bound in HISTOGRAM_BOUNDS_MS] \
+            + [f"gt_{HISTOGRAM_BOUNDS_MS[-1]}ms"]
+        row.update(zip(bounds, self.histogram))
+        return row
+
+
+class PipelineMetrics:
+    """
+    stage statistics over all updates plus plain event counters,
+    thread safe so the render threads and the GUI add to the same one
+    """
+
+    def __init__(self):
+        self.stages = dict()
+        self.counters = dict()
+        self.lock = threading.Lock()
+
+    def add_timing(self, name: str, seconds: float, memory: int = 0):
+        """ one run of a stage timed outside of a StageTimer """
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = StageStatistics()
+            self.stages[name].add(seconds, memory)
+
+    def add(self, timer: StageTimer):
+        """ every stage of a finished update """
+        for name, seconds in timer.timings.items():
+            self.add_timing(name, seconds, timer.memory.get(name, 0))
+
+    def count(self, name: str, amount: int = 1):
+        """ increment an event counter """
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def rows(self):
+        """ one row per stage, slowest total first """
+        with self.lock:
+            rows = [
+                statistics.row(name)
+                for name, statistics in self.stages.items()
+            ]
+        return sorted(rows, key=lambda row: -row['total_ms'])
+
+    def to_json(self, path: str):
+        """ stages and counters as one json document """
+        with self.lock:
+            counters = dict(self.counters)
+        with open(path, "w") as file:
+            json.dump(
+                {'stages': self.rows(), 'counters': counters}, file, indent=1
+            )
+
+    def to_csv(self, path: str):
+        """ the stage rows, the counters are left out """
+        rows = self.rows()
+        if not rows:
+            return
+        with open(path, "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def export(self, path: str):
+        """ csv or json, chosen by the file extension """
+        if path.endswith(".csv"):
+            self.to_csv(path)
+        else:
+            self.to_json(path)
+
+    def summary(self, stages: int = 5):
+        """ one line with the stages taking the most time in total """
+        return ", ".join(
+            f"{row['stage']} {row['count']}x {row['mean_ms']:.0f} ms"
+            for row in self.rows()[:stages]
+        )
+
+
+class ProfileCapture:
+    """
+    opt-in profiling of single blocks: "cprofile" writes the pstats of
+    the block's thread, "tracemalloc" the lines allocating the most
+    memory in it; without a mode the block runs unchanged
+    """
+
+    def __init__(self, mode: str = None, directory: str = "profiles"):
+        if mode and mode not in PROFILE_MODES:
+            raise ValueError(f"unknown profile mode {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.sequence = itertools.count(1)
+        if self.mode:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, name: str, extension: str):
+        """ a new file in the directory for every capture """
+        return os.path.join(
+            self.directory, f"{name}_{next(self.sequence):04d}.{extension}"
+        )
+
+    @contextmanager
+    def capture(self, name: str):
+        """ profile the enclosed block into a file named after name """
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(self.path(name, "pstats"))
+        elif self.mode == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            before = tracemalloc.take_snapshot()
+            try:
+                yield
+            finally:
+                statistics = tracemalloc.take_snapshot().compare_to(
+                    before, "lineno"
+                )
+                with open(self.path(name, "txt"), "w") as file:
+                    for statistic in statistics[:TRACEMALLOC_TOP]:
+                        file.write(str(statistic) + "\n")
+        else:
+            yield
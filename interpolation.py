@@ -0,0 +1,246 @@
+"""
+Interpolation of the scattered measurements onto the contour grid,
+the geometry is cached so that a new day or threshold on the same
+measurement positions only costs a sparse matrix vector product
+"""
+import hashlib
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree, Delaunay
+
+INTERPOLATION_METHODS = ["linear", "idw", "nearest"]
+# grid size along the longer side the smoothing strengths were chosen for
+REFERENCE_RESOLUTION = 500
+
+
+class GridGeometry:
+    """ sparse weights from the unique measurement positions to the
+    grid cells, cells without weights are outside of the data """
+
+    def __init__(self, weights: csr_matrix, outside: numpy.ndarray):
+        self.weights = weights
+        self.outside = outside
+
+
+def unique_points(x_data: numpy.ndarray, y_data: numpy.ndarray):
+    """
+    the set of measurement positions, repeated positions (the same
+    station or model point at several hours) are merged into one
+    """
+    points = numpy.column_stack((x_data, y_data))
+    points, inverse = numpy.unique(points, axis=0, return_inverse=True)
+    return points, inverse.reshape(-1)
+
+
+def mean_per_point(
+    z_data: numpy.ndarray, inverse: numpy.ndarray, n_points: int
+):
+    """ mean of the values measured at each unique position """
+    valid = ~numpy.isnan(z_data)
+    sums = numpy.bincount(
+        inverse[valid], weights=z_data[valid], minlength=n_points
+    )
+    counts = numpy.bincount(inverse[valid], minlength=n_points)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def linear_geometry(points: numpy.ndarray, grid: numpy.ndarray):
+    """ barycentric weights of the Delaunay triangulation,
+    the same interpolant scipy's griddata(method='linear') uses """
+    triangulation = Delaunay(points)
+    simplex = triangulation.find_simplex(grid)
+    inside = simplex >= 0
+
+    transform = triangulation.transform[simplex[inside]]
+    delta = grid[inside] - transform[:, 2]
+    barycentric = numpy.einsum('ijk,ik->ij', transform[:, :2], delta)
+    weights = numpy.column_stack(
+        (barycentric, 1.0 - barycentric.sum(axis=1))
+    )
+
+    rows = numpy.repeat(numpy.flatnonzero(inside), 3)
+    columns = triangulation.simplices[simplex[inside]].ravel()
+    matrix = csr_matrix(
+        (weights.ravel(), (rows, columns)),
+        shape=(len(grid), len(points))
+    )
+    return GridGeometry(matrix, ~inside)
+
+
+def neighbour_geometry(
+    points: numpy.ndarray, grid: numpy.ndarray, neighbours: int,
+    power: float, max_distance: float = None
+):
+    """ inverse distance weights of the nearest neighbours from a KD-tree,
+    a single neighbour gives nearest neighbour interpolation """
+    neighbours = min(neighbours, len(points))
+    distances, indices = cKDTree(points).query(grid, k=neighbours)
+    distances = distances.reshape(len(grid), neighbours)
+    indices = indices.reshape(len(grid), neighbours)
+
+    with numpy.errstate(divide='ignore'):
+        weights = 1.0 / distances ** power
+    # a cell lying exactly on a measurement takes its value
+    exact = distances[:, 0] == 0.0
+    weights[exact] = 0.0
+    weights[exact, 0] = 1.0
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    outside = numpy.zeros(len(grid), dtype=bool)
+    if max_distance is not None:
+        outside = distances[:, 0] > max_distance
+        weights[outside] = 0.0
+
+    rows = numpy.repeat(numpy.arange(len(grid)), neighbours)
+    matrix = csr_matrix(
+        (weights.ravel(), (rows, indices.ravel())),
+        shape=(len(grid), len(points))
+    )
+    return GridGeometry(matrix, outside)
+
+
+class GridInterpolator:
+    """
+    interpolates onto a regular grid, the geometry is cached
+    by the set of measurement positions and the grid
+    """
+
+    def __init__(
+        self, method: str = "linear", cached_geometries: int = 8,
+        neighbours: int = 8, power: float = 2.0, max_distance: float = None
+    ):
+        if method not in INTERPOLATION_METHODS:
+            raise ValueError(f"unknown interpolation method {method}")
+        self.method = method
+        self.cached_geometries = cached_geometries
+        self.neighbours = neighbours
+        self.power = power
+        self.max_distance = max_distance
+        self.geometries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def geometry_key(
+        self, points: numpy.ndarray, x_lin: numpy.ndarray,
+        y_lin: numpy.ndarray
+    ):
+        """ hash of the point set, the grid and the method """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.method.encode())
+        for array in (points, x_lin, y_lin):
+            digest.update(numpy.ascontiguousarray(array).tobytes())
+        return digest.digest()
+
+    def build_geometry(self, points: numpy.ndarray, grid: numpy.ndarray):
+        """ weights for the configured method """
+        if self.method == "linear":
+            return linear_geometry(points, grid)
+        neighbours = 1 if self.method == "nearest" else self.neighbours
+        return neighbour_geometry(
+            points, grid, neighbours, self.power, self.max_distance
+        )
+
+    def geometry(
+        self, points: numpy.ndarray, x_lin: numpy.ndarray,
+        y_lin: numpy.ndarray
+    ):
+        """ cached geometry of the point set on the grid """
+        key = self.geometry_key(points, x_lin, y_lin)
+        with self.lock:
+            if key in self.geometries:
+                self.geometries.move_to_end(key)
+                return self.geometries[key]
+
+        x_mesh, y_mesh = numpy.meshgrid(x_lin, y_lin)
+        grid = numpy.column_stack((x_mesh.ravel(), y_mesh.ravel()))
+        geometry = self.build_geometry(points, grid)
+
+        with self.lock:
+            self.geometries[key] = geometry
+            while len(self.geometries) > self.cached_geometries:
+                self.geometries.popitem(last=False)
+        return geometry
+
+    def interpolate(
+        self, x_data: numpy.ndarray, y_data: numpy.ndarray,
+        z_data: numpy.ndarray, x_lin: numpy.ndarray, y_lin: numpy.ndarray
+    ):
+        """
+        values on the grid spanned by x_lin and y_lin, shaped like
+        numpy.meshgrid(x_lin, y_lin), cells outside the data are nan
+        """
+        points, inverse = unique_points(x_data, y_data)
+        z_points = mean_per_point(
+            numpy.asarray(z_data, dtype=float), inverse, len(points)
+        )
+        geometry = self.geometry(points, x_lin, y_lin)
+
+        z_mesh = geometry.weights @ z_points
+        z_mesh[geometry.outside] = numpy.nan
+        return z_mesh.reshape(len(y_lin), len(x_lin))
+
+
+@dataclass
+class GridResolutionPolicy:
+    """
+    chooses the size of the contour grid, the longer side of the
+    bounding box gets the resolution of the level of detail and the
+    shorter one follows the aspect ratio, sparse data gets a coarser grid
+    """
+    full_resolution: int = REFERENCE_RESOLUTION
+    preview_resolution: int = 120
+    min_resolution: int = 40
+    cells_per_point: float = 16.0
+
+    def grid_shape(
+        self, x_data: numpy.ndarray, y_data: numpy.ndarray,
+        preview: bool = False
+    ):
+        """ (cells along x, cells along y) for the data """
+        resolution = self.preview_resolution if preview \
+            else self.full_resolution
+
+        # degrees of longitude are shorter than degrees of latitude
+        x_extent = numpy.ptp(x_data) * math.cos(
+            math.radians(numpy.mean(y_data))
+        )
+        y_extent = numpy.ptp(y_data)
+        longer_extent = max(x_extent, y_extent)
+        if longer_extent == 0.0:
+            return self.min_resolution, self.min_resolution
+
+        # more cells than measurements only blur the triangles
+        max_cells = self.cells_per_point * len(x_data)
+        aspect = min(x_extent, y_extent) / longer_extent
+        resolution = min(
+            resolution, int(math.sqrt(max_cells / max(aspect, 1e-3)))
+        )
+        resolution = max(resolution, self.min_resolution)
+
+        short_side = max(self.min_resolution, round(resolution * aspect))
+        if x_extent >= y_extent:
+            return resolution, short_side
+        return short_side, resolution
+
+    def grid(
+        self, x_data: numpy.ndarray, y_data: numpy.ndarray,
+        preview: bool = False
+    ):
+        """ x_lin and y_lin spanning the bounding box of the data """
+        x_cells, y_cells = self.grid_shape(x_data, y_data, preview)
+        x_lin = numpy.linspace(numpy.min(x_data), numpy.max(x_data), x_cells)
+        y_lin = numpy.linspace(numpy.min(y_data), numpy.max(y_data), y_cells)
+        return x_lin, y_lin
+
+
+def smoothing_sigma(strength: float, x_lin: numpy.ndarray,
+                    y_lin: numpy.ndarray):
+    """ gaussian sigma in cells, scaled so that a smoothing strength
+    looks the same at every grid resolution """
+    scale = max(len(x_lin), len(y_lin)) / REFERENCE_RESOLUTION
+    return [strength * scale, strength * scale]
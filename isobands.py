@@ -0,0 +1,113 @@
+"""
+Filled contour bands of a grid as compact GeoJSON,
+marching squares from contourpy without any matplotlib figure
+"""
+import json
+
+import numpy
+import shapely
+from contourpy import FillType, contour_generator
+
+
+def band_rings(generator, lower: float, upper: float):
+    """
+    the polygons of the grid between both levels, every polygon is a
+    list of rings (outer ring first, then the holes) as (n, 2) arrays
+    """
+    points, offsets = generator.filled(lower, upper)
+    return [
+        numpy.split(polygon_points, polygon_offsets[1:-1])
+        for polygon_points, polygon_offsets in zip(points, offsets)
+    ]
+
+
+def simplify_polygons(polygons: list, tolerance: float):
+    """
+    Douglas-Peucker on all rings at once, rings that collapse are
+    dropped, a polygon without its outer ring is dropped completely
+    """
+    rings = [ring for polygon in polygons for ring in polygon]
+    if not rings or tolerance <= 0.0:
+        return polygons
+    ring_index = numpy.repeat(
+        numpy.arange(len(rings)), [len(ring) for ring in rings]
+    )
+    simplified = shapely.simplify(
+        shapely.linearrings(numpy.concatenate(rings), indices=ring_index),
+        tolerance, preserve_topology=False
+    )
+    coordinates, index = shapely.get_coordinates(
+        simplified, return_index=True
+    )
+    ring_coordinates = numpy.split(
+        coordinates,
+        numpy.searchsorted(index, numpy.arange(1, len(rings)))
+    )
+
+    result = list()
+    position = 0
+    for polygon in polygons:
+        kept = [
+            ring_coordinates[position + i] for i in range(len(polygon))
+            if len(ring_coordinates[position + i]) >= 4
+        ]
+        if kept and len(ring_coordinates[position]) >= 4:
+            result.append(kept)
+        position += len(polygon)
+    return result
+
+
+def band_feature(polygons: list, color: str, title: str, ndigits: int):
+    """ a MultiPolygon feature with the styling the map page expects,
+    the coordinates are quantized to ndigits decimals """
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'MultiPolygon',
+            'coordinates': [
+                [numpy.round(ring, ndigits).tolist() for ring in polygon]
+                for polygon in polygons
+            ],
+        },
+        'properties': {
+            'stroke-width': 1,
+            'stroke': color,
+            'fill': color,
+            'fill-opacity': 0.5,
+            'title': title,
+        },
+    }
+
+
+def contour_bands_geojson(
+    x_lin: numpy.ndarray, y_lin: numpy.ndarray, z_mesh: numpy.ndarray,
+    levels: list, colors: list, ndigits: int = 4, tolerance: float = None
+):
+    """
+    one feature per band between two neighbouring levels, simplified
+    by default with half a grid cell, serialized without whitespace
+    """
+    if tolerance is None:
+        tolerance = 0.5 * min(
+            numpy.ptp(x_lin) / max(len(x_lin) - 1, 1),
+            numpy.ptp(y_lin) / max(len(y_lin) - 1, 1)
+        )
+    generator = contour_generator(
+        x_lin, y_lin, numpy.ma.masked_invalid(z_mesh),
+        name="serial", fill_type=FillType.OuterOffset, corner_mask=True
+    )
+    # the bands are closed at the top, the lowest one also at the bottom
+    lowers = [numpy.nextafter(levels[0], -numpy.inf)] + list(levels[1:-1])
+    features = list()
+    for lower, upper, color in zip(lowers, levels[1:], colors):
+        polygons = simplify_polygons(
+            band_rings(generator, lower, upper), tolerance
+        )
+        if polygons:
+            features.append(band_feature(
+                polygons, color, f"{lower:.2f}-{upper:.2f}", ndigits
+            ))
+    return json.dumps(
+        {'type': 'FeatureCollection', 'features': features},
+        separators=(',', ':')
+    )
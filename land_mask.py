@@ -0,0 +1,137 @@
+"""
+Raster of the land area from data/GermanyPolygon.json,
+rasterized once and cached as a packed binary next to the polygon
+"""
+import json
+import os
+
+import numpy
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+LAND_POLYGON_PATH = "data/GermanyPolygon.json"
+LAND_MASK_PATH = "data/land_mask.npz"
+# raster cell size in degrees, about 350 m in longitude at the coast
+LAND_MASK_RESOLUTION = 0.005
+
+
+class LandMask:
+    """
+    boolean raster in longitude/latitude, a position is looked up by
+    its raster cell so grids of any shape and points are masked with
+    a few array operations
+    """
+
+    def __init__(self, land: numpy.ndarray, x_start: float, y_start: float,
+                 resolution: float):
+        self.land = land
+        self.x_start = x_start
+        self.y_start = y_start
+        self.resolution = resolution
+
+    def is_land(self, x: numpy.ndarray, y: numpy.ndarray):
+        """ True for the positions on land, outside the raster is sea """
+        column = numpy.floor((x - self.x_start) / self.resolution)
+        row = numpy.floor((y - self.y_start) / self.resolution)
+        inside = (column >= 0) & (column < self.land.shape[1]) \
+            & (row >= 0) & (row < self.land.shape[0])
+        land = numpy.zeros(numpy.shape(x), dtype=bool)
+        land[inside] = self.land[
+            row[inside].astype(numpy.intp), column[inside].astype(numpy.intp)
+        ]
+        return land
+
+    def grid_land(self, x_lin: numpy.ndarray, y_lin: numpy.ndarray):
+        """ (len(y_lin), len(x_lin)) mask of a contour grid """
+        x_mesh, y_mesh = numpy.meshgrid(x_lin, y_lin)
+        return self.is_land(x_mesh, y_mesh)
+
+    def clip_grid(self, x_lin: numpy.ndarray, y_lin: numpy.ndarray,
+                  z_mesh: numpy.ndarray):
+        """ copy of the grid values without the cells on land """
+        z_mesh = z_mesh.copy()
+        z_mesh[self.grid_land(x_lin, y_lin)] = numpy.nan
+        return z_mesh
+
+    def filter_points(self, df: pd.DataFrame):
+        """ the rows of the measurements in the sea """
+        return df[~self.is_land(
+            df['longitude'].to_numpy(dtype=float),
+            df['latitude'].to_numpy(dtype=float)
+        )]
+
+
+def rasterize_polygon(path: str, resolution: float):
+    """ the land mask of a GeoJSON (multi) polygon, simplified to the
+    raster resolution first, a cell is land if its center is """
+    with open(path) as file:
+        polygon = shape(json.load(file))
+    polygon = polygon.simplify(resolution / 2.0)
+    shapely.prepare(polygon)
+
+    x_start, y_start, x_end, y_end = polygon.bounds
+    columns = int(numpy.ceil((x_end - x_start) / resolution))
+    rows = int(numpy.ceil((y_end - y_start) / resolution))
+    x_centers = x_start + (numpy.arange(columns) + 0.5) * resolution
+    y_centers = y_start + (numpy.arange(rows) + 0.5) * resolution
+
+    land = numpy.empty((rows, columns), dtype=bool)
+    for row, y_center in enumerate(y_centers):
+        land[row] = shapely.contains_xy(polygon, x_centers, y_center)
+    return LandMask(land, x_start, y_start, resolution)
+
+
+def source_stamp(path: str):
+    """ size and modification time of the polygon file """
+    stat = os.stat(path)
+    return numpy.array([stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+
+def write_land_mask(cache_path: str, land_mask: LandMask, stamp):
+    """ bit packed, written to a temporary file first """
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        numpy.savez_compressed(
+            file,
+            bits=numpy.packbits(land_mask.land),
+            shape=numpy.array(land_mask.land.shape),
+            origin=numpy.array([land_mask.x_start, land_mask.y_start]),
+            resolution=numpy.array(land_mask.resolution),
+            stamp=stamp
+        )
+    os.replace(tmp_path, cache_path)
+
+
+def read_land_mask(cache_path: str, stamp, resolution: float):
+    """ the cached mask, None if it is missing or outdated """
+    if not os.path.exists(cache_path):
+        return None
+    with numpy.load(cache_path) as data:
+        if not numpy.array_equal(data['stamp'], stamp) \
+                or float(data['resolution']) != resolution:
+            return None
+        shape_ = tuple(data['shape'])
+        land = numpy.unpackbits(
+            data['bits'], count=shape_[0] * shape_[1]
+        ).reshape(shape_).astype(bool)
+        x_start, y_start = data['origin']
+        return LandMask(land, float(x_start), float(y_start), resolution)
+
+
+def load_land_mask(
+    path: str = LAND_POLYGON_PATH,
+    cache_path: str = LAND_MASK_PATH,
+    resolution: float = LAND_MASK_RESOLUTION
+):
+    """ the land mask from the cache, rasterized again when the
+    polygon file changed since it was written """
+    stamp = source_stamp(path)
+    land_mask = read_land_mask(cache_path, stamp, resolution)
+    if land_mask is None:
+        land_mask = rasterize_polygon(path, resolution)
+        try:
+            write_land_mask(cache_path, land_mask, stamp)
+        except OSError:  # read-only data directory, keep it in memory
+            pass
+    return land_mask
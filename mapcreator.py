@@ -0,0 +1,522 @@
+"""
+Central File for the map products, independent of the GUI
+"""
+import base64
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy
+import pandas as pd
+import scipy as sp
+
+from data_access import DataStore, MapData
+from diagramcreator import SortedExtremes, sensor_block
+from instrumentation import StageTimer
+from isobands import contour_bands_geojson
+from mappage import legend_data
+from interpolation import (
+    GridInterpolator,
+    GridResolutionPolicy,
+    smoothing_sigma
+)
+
+
+@dataclass
+class SalinityMesh:
+    """ the interpolated (and smoothed) salinity on the contour grid """
+    x_lin: numpy.ndarray
+    y_lin: numpy.ndarray
+    z_mesh: numpy.ndarray
+    sal_min: float
+    sal_max: float
+
+
+def create_salinity_df(md: MapData):
+    """ construct dataframe with salinity """
+    df = pd.concat(
+        (
+            md.data_obs[['latitude', 'longitude', 'sensor_1']],
+            md.data_bw[['latitude', 'longitude', 'sensor_1']],
+            md.data_fw[['latitude', 'longitude', 'sensor_1']],
+        )
+    )
+
+    return df
+
+
+def salinity_levels(sal_min: float, sal_max: float, sal_val: float):
+    """ contour levels and colors, split at the selected salinity """
+    # make sure salinity is between min and max
+    if sal_val < sal_min:
+        levels = [
+            sal_min,
+            sal_min + 0.3 * (sal_max - sal_min),
+            sal_max
+            ]
+        colors = ['#77b5d4', '#06618f']
+    elif sal_val > sal_max:
+        levels = [
+            sal_min,
+            sal_min + 0.7 * (sal_max - sal_min),
+            sal_max
+            ]
+        colors = ['#b5212f', '#de7881']
+    else:
+        levels = [
+            sal_min,
+            sal_min + 0.7 * (sal_val - sal_min),
+            sal_val,
+            sal_val + 0.3 * (sal_max - sal_val),
+            sal_max
+            ]
+        colors = ['#b5212f', '#de7881', '#77b5d4', '#06618f']
+    return levels, colors
+
+
+def points_payload(df: pd.DataFrame, levels: list, colors: list):
+    """
+    all measurements as one compact JSON object for the canvas layer
+    of the map page: base64 coded float32 coordinates and the uint8
+    index of the color class of every point, points aggregated by
+    reduce_points also carry their mean, min, max and count
+    """
+    salinity = df['sensor_1'].to_numpy(dtype=float)
+    valid = ~numpy.isnan(salinity)
+    classes = numpy.searchsorted(
+        numpy.asarray(levels[1:-1], dtype=float), salinity[valid]
+    ).astype(numpy.uint8)
+    latitude = df['latitude'].to_numpy(dtype='<f4')[valid]
+    longitude = df['longitude'].to_numpy(dtype='<f4')[valid]
+
+    payload = {
+        "count": int(valid.sum()),
+        "latitude": base64.b64encode(latitude.tobytes()).decode(),
+        "longitude": base64.b64encode(longitude.tobytes()).decode(),
+        "classes": base64.b64encode(classes.tobytes()).decode(),
+        "colors": colors,
+    }
+    if 'count' in df.columns:
+        # the map page sizes the cells by count and shows their range
+        for key, column, dtype in (
+            ("mean", 'sensor_1', '<f4'),
+            ("minimum", 'sensor_1_min', '<f4'),
+            ("maximum", 'sensor_1_max', '<f4'),
+            ("cell_count", 'count', '<u4'),
+        ):
+            values = df[column].to_numpy(dtype=dtype)[valid]
+            payload[key] = base64.b64encode(values.tobytes()).decode()
+    return json.dumps(payload)
+
+
+def mercator_pixels(
+    latitude: numpy.ndarray, longitude: numpy.ndarray, zoom: int
+):
+    """ web mercator pixel coordinates at the zoom level of the map """
+    scale = 256.0 * 2.0 ** zoom
+    sin = numpy.sin(numpy.radians(latitude))
+    x = scale * (longitude + 180.0) / 360.0
+    y = scale * (0.5 - numpy.log((1.0 + sin) / (1.0 - sin)) / (4.0 * numpy.pi))
+    return x, y
+
+
+def reduce_points(
+    df: pd.DataFrame, zoom: int, budget: int, cell_pixels: float = 4.0
+):
+    """
+    aggregates the points per screen cell at the zoom level until at
+    most budget cells are left, every cell becomes one point at the
+    mean position with the mean salinity plus the min, max and count,
+    a point alone in its cell is kept as it is
+    """
+    df = df[df['sensor_1'].notna()]
+    if len(df.index) <= budget:
+        return df
+
+    latitude = df['latitude'].to_numpy(dtype=float)
+    longitude = df['longitude'].to_numpy(dtype=float)
+    salinity = df['sensor_1'].to_numpy(dtype=float)
+    x, y = mercator_pixels(latitude, longitude, zoom)
+
+    while True:
+        cell_x = numpy.floor(x / cell_pixels).astype(numpy.int64)
+        cell_y = numpy.floor(y / cell_pixels).astype(numpy.int64)
+        cells, inverse, counts = numpy.unique(
+            (cell_x << 32) | cell_y, return_inverse=True, return_counts=True
+        )
+        if len(cells) <= budget:
+            break
+        cell_pixels *= 2.0
+    inverse = inverse.reshape(-1)
+
+    # sorting by cell makes every cell a contiguous run for reduceat
+    order = numpy.argsort(inverse, kind='stable')
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+    sorted_salinity = salinity[order]
+
+    return pd.DataFrame({
+        'latitude': numpy.bincount(inverse, weights=latitude) / counts,
+        'longitude': numpy.bincount(inverse, weights=longitude) / counts,
+        'sensor_1': numpy.bincount(inverse, weights=salinity) / counts,
+        'sensor_1_min': numpy.minimum.reduceat(sorted_salinity, starts),
+        'sensor_1_max': numpy.maximum.reduceat(sorted_salinity, starts),
+        'count': counts,
+    })
+
+
+def compute_mesh(
+    df: pd.DataFrame,
+    interpolator: GridInterpolator,
+    grid_policy: GridResolutionPolicy,
+    smoothing: int,
+    preview: bool = False,
+    timer: StageTimer = None
+):
+    """ interpolate the salinity onto the grid and smoothen it,
+    this does not depend on the selected salinity """
+    timer = timer or StageTimer()
+
+    # data to arrays
+    x_data = df['longitude'].to_numpy(dtype=float)
+    y_data = df['latitude'].to_numpy(dtype=float)
+    z_data = df['sensor_1'].to_numpy(dtype=float)
+
+    # build grid
+    x_lin, y_lin = grid_policy.grid(x_data, y_data, preview)
+
+    # add sensor values to grid, the triangulation is reused
+    # as long as the measurement positions stay the same
+    with timer.stage("interpolation"):
+        z_mesh = interpolator.interpolate(
+            x_data, y_data, z_data, x_lin, y_lin
+        )
+
+    # optional gaussian filter to smoothen contour map
+    if smoothing > 0:
+        with timer.stage("smoothing"):
+            sigma = smoothing_sigma(smoothing, x_lin, y_lin)
+            z_mesh = sp.ndimage.gaussian_filter(
+                z_mesh, sigma, mode='constant'
+            )
+
+    return SalinityMesh(
+        x_lin, y_lin, z_mesh,
+        df['sensor_1'].min(), df['sensor_1'].max()
+    )
+
+
+def contour_geojson(
+    mesh: SalinityMesh, levels: list, colors: list,
+    timer: StageTimer = None
+):
+    """ filled contours of the mesh as GeoJSON """
+    timer = timer or StageTimer()
+    with timer.stage("contours"):
+        return contour_bands_geojson(
+            mesh.x_lin, mesh.y_lin, mesh.z_mesh, levels, colors
+        )
+
+
+def result_bytes(value):
+    """ estimated memory of a cached result """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(result_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(result_bytes(item) for item in value)
+    if hasattr(value, '__dict__'):
+        return sum(result_bytes(item) for item in vars(value).values())
+    return 64
+
+
+class ResultCache:
+    """
+    least recently used results of the update pipeline (windows,
+    meshes and layers) within a budget of bytes, counts hits, misses
+    and evictions
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2**20):
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple):
+        """ the cached result or None """
+        with self.lock:
+            entry = self.results.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.results.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: tuple, value):
+        """ keep a result, the least recently used ones are dropped
+        until the budget fits, results above the budget are not kept """
+        size = result_bytes(value)
+        with self.lock:
+            if key in self.results:
+                self.used_bytes -= self.results.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self.results[key] = (value, size)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                self.used_bytes -= self.results.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def summary(self):
+        """ one line with the statistics for the status bar """
+        with self.lock:
+            return (
+                f"cache {self.hits} hits, {self.misses} misses, "
+                f"{self.evictions} evictions, "
+                f"{self.used_bytes / 2**20:.0f} of "
+                f"{self.max_bytes / 2**20:.0f} MB"
+            )
+
+
+@dataclass
+class UpdateRequest:
+    """ everything an update of the map depends on """
+    start_key: int
+    end_key: int
+    sal_val: float
+    smoothing: int = 0
+    show_points: bool = False
+    preview: bool = False
+    zoom: int = 10
+    # "raw" or one of the per cell aggregations of window_aggregation
+    aggregation: str = "raw"
+
+
+@dataclass
+class UpdateResult:
+    """ the data of the window and the layers for the map page """
+    request: UpdateRequest
+    m_data: MapData
+    layers: dict
+    points_reduced: bool = False
+    radar: dict = None
+
+
+class UpdateCancelled(Exception):
+    """ a newer request superseded the running one """
+
+
+class MapRenderer:
+    """
+    builds the map layers for an update request, shared by the GUI
+    and everything else that renders maps, the caches are thread safe
+    """
+
+    def __init__(
+        self,
+        data_store: DataStore,
+        interpolator: GridInterpolator,
+        grid_policy: GridResolutionPolicy,
+        point_budget: int,
+        contour_cache=None,
+        cache_bytes: int = 512 * 2**20,
+        land_mask=None,
+        aggregator=None
+    ):
+        self.data_store = data_store
+        self.interpolator = interpolator
+        self.grid_policy = grid_policy
+        self.point_budget = point_budget
+        self.result_cache = ResultCache(cache_bytes)
+        # precomputed full resolution meshes of whole days, optional
+        self.contour_cache = contour_cache
+        # clips the contours and filters the points on land, optional
+        self.land_mask = land_mask
+        # sliding window aggregates per cell, needed for aggregated requests
+        self.aggregator = aggregator
+
+    def get_data_for_time_range(self, start_key: int, end_key: int):
+        """ returns an object (currently "struct" of dataframes)
+        which contains the data relevant for the given time """
+        window_key = ("window", start_key, end_key)
+        m_data = self.result_cache.get(window_key)
+        if m_data is None:
+            m_data = self.data_store.get_window(start_key, end_key)
+            self.result_cache.put(window_key, m_data)
+        return m_data
+
+    def salinity_df(self, md: MapData, request: UpdateRequest):
+        """ the measurements of the window, or one row per cell with
+        the aggregated value at the cell center """
+        if request.aggregation == "raw":
+            return create_salinity_df(md)
+        frame_key = (
+            "aggregate", request.start_key, request.end_key,
+            request.aggregation
+        )
+        df = self.result_cache.get(frame_key)
+        if df is None:
+            df = self.aggregator.frame(
+                request.start_key, request.end_key, request.aggregation
+            )
+            self.result_cache.put(frame_key, df)
+        return df
+
+    def draw_points(self, md: MapData, request: UpdateRequest):
+        """ the points layer and its legend, and if it was aggregated """
+        df = self.salinity_df(md, request)
+        if self.land_mask is not None:
+            df = self.land_mask.filter_points(df)
+        if df.empty:
+            return dict(), False
+
+        # color stuff for the map
+        sal_min = df['sensor_1'].min()
+        sal_max = df['sensor_1'].max()
+        levels, colors = salinity_levels(sal_min, sal_max, request.sal_val)
+
+        # aggregate per screen cell if there are more points than budget
+        points = reduce_points(df, request.zoom, self.point_budget)
+
+        layers = {
+            'points': points_payload(points, levels, colors),
+            'legend': legend_data(levels, colors),
+        }
+        return layers, len(points.index) < len(df.index)
+
+    def clip_land(self, mesh: SalinityMesh, timer: StageTimer):
+        """ the mesh without the cells on land """
+        if self.land_mask is None:
+            return mesh
+        with timer.stage("land mask"):
+            return SalinityMesh(
+                mesh.x_lin, mesh.y_lin,
+                self.land_mask.clip_grid(mesh.x_lin, mesh.y_lin, mesh.z_mesh),
+                mesh.sal_min, mesh.sal_max
+            )
+
+    def salinity_mesh(
+        self, md: MapData, request: UpdateRequest, timer: StageTimer
+    ):
+        """ the mesh of the window from the caches or interpolated,
+        None if there is no data """
+        mesh_key = (
+            "mesh", request.start_key, request.end_key,
+            request.smoothing, request.preview, request.aggregation
+        )
+        mesh = self.result_cache.get(mesh_key)
+        if mesh is None and self.contour_cache is not None \
+                and not request.preview and request.aggregation == "raw":
+            with timer.stage("contour cache"):
+                mesh = self.contour_cache.get(
+                    request.start_key, request.end_key, request.smoothing
+                )
+            if mesh is not None:
+                mesh = self.clip_land(mesh, timer)
+                self.result_cache.put(mesh_key, mesh)
+        if mesh is None:
+            df = self.salinity_df(md, request)
+            if df.empty:
+                return None
+            mesh = compute_mesh(
+                df, self.interpolator, self.grid_policy,
+                request.smoothing, request.preview, timer
+            )
+            mesh = self.clip_land(mesh, timer)
+            self.result_cache.put(mesh_key, mesh)
+        return mesh
+
+    def draw_contour_map(
+        self, md: MapData, request: UpdateRequest, timer: StageTimer
+    ):
+        """ the contour layer and its legend, the mesh of a time window
+        is cached so a new salinity only recomputes the contours """
+        mesh = self.salinity_mesh(md, request, timer)
+        if mesh is None:
+            return dict()
+
+        # color stuff for the map
+        levels, colors = salinity_levels(
+            mesh.sal_min, mesh.sal_max, request.sal_val
+        )
+
+        geo_json = contour_geojson(mesh, levels, colors, timer)
+
+        return {
+            'contours': geo_json,
+            'legend': legend_data(levels, colors),
+        }
+
+    @staticmethod
+    def layers_key(request: UpdateRequest):
+        """ what the layers depend on, the smoothing only matters for
+        the contours and the zoom only for aggregated points """
+        if request.show_points:
+            return (
+                request.start_key, request.end_key, request.sal_val,
+                request.aggregation, "points", request.zoom
+            )
+        return (
+            request.start_key, request.end_key, request.sal_val,
+            request.aggregation, "contours", request.smoothing,
+            request.preview
+        )
+
+    def radar_extremes(self, md: MapData, request: UpdateRequest):
+        """ min and max per sensor on both sides of the threshold,
+        the sorted window is kept so a new threshold is a lookup """
+        radar_key = ("radar", request.start_key, request.end_key)
+        sorted_extremes = self.result_cache.get(radar_key)
+        if sorted_extremes is None:
+            sorted_extremes = SortedExtremes(sensor_block(md))
+            self.result_cache.put(radar_key, sorted_extremes)
+        return sorted_extremes.extremes(request.sal_val)
+
+    def render(
+        self, request: UpdateRequest, timer: StageTimer,
+        check_cancelled=lambda: None
+    ):
+        """
+        query the window and draw the contour map or the points,
+        check_cancelled raises UpdateCancelled between the stages
+        """
+        with timer.stage("query"):
+            m_data = self.get_data_for_time_range(
+                request.start_key, request.end_key
+            )
+        check_cancelled()
+
+        # going back to a day shows the same layers again
+        layers_key = ("layers", *self.layers_key(request))
+        cached = self.result_cache.get(layers_key)
+        if cached is None and request.aggregation != "raw":
+            # slides the aggregated window, the frame is cached for drawing
+            with timer.stage("aggregation"):
+                self.salinity_df(m_data, request)
+            check_cancelled()
+        if cached is not None:
+            layers, points_reduced = cached
+        elif request.show_points:
+            with timer.stage("points"):
+                layers, points_reduced = self.draw_points(m_data, request)
+            self.result_cache.put(layers_key, (layers, points_reduced))
+        else:
+            layers = self.draw_contour_map(m_data, request, timer)
+            points_reduced = False
+            self.result_cache.put(layers_key, (layers, points_reduced))
+        check_cancelled()
+
+        with timer.stage("radar stats"):
+            radar = self.radar_extremes(m_data, request)
+
+        return UpdateResult(request, m_data, layers, points_reduced, radar)
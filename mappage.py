@@ -0,0 +1,289 @@
+"""
+The persistent map page, it is loaded once and the layers are
+replaced through JavaScript so zoom, pan and tiles survive an update
+"""
+import json
+
+import folium
+from branca.element import MacroElement
+from jinja2 import Template
+
+
+class LayerBridge(MacroElement):
+    """ adds window.conceptva.update(payload) to the folium map """
+
+    _template = Template("""
+        {% macro header(this, kwargs) %}
+            <script src="qrc:///qtwebchannel/qwebchannel.js"></script>
+            <style>
+                .conceptva-legend {
+                    background: white;
+                    padding: 6px 8px;
+                    font: 12px sans-serif;
+                    border-radius: 4px;
+                }
+                .conceptva-legend i {
+                    display: inline-block;
+                    width: 14px;
+                    height: 14px;
+                    margin-right: 6px;
+                    vertical-align: middle;
+                    opacity: 0.7;
+                }
+            </style>
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+            (function() {
+                var map = {{ this._parent.get_name() }};
+                var contourLayer = null;
+                var pointLayer = null;
+
+                var legend = L.control({position: 'topright'});
+                legend.onAdd = function() {
+                    this._div = L.DomUtil.create('div', 'conceptva-legend');
+                    this._div.style.display = 'none';
+                    return this._div;
+                };
+                legend.addTo(map);
+
+                function replaceLayer(oldLayer, newLayer) {
+                    if (oldLayer !== null) {
+                        map.removeLayer(oldLayer);
+                    }
+                    if (newLayer !== null) {
+                        newLayer.addTo(map);
+                    }
+                    return newLayer;
+                }
+
+                function contourLayerOf(geojson) {
+                    return L.geoJson(geojson, {
+                        style: function(feature) {
+                            return {
+                                color: feature.properties['stroke'],
+                                weight: feature.properties['stroke-width'],
+                                fillColor: feature.properties['fill'],
+                                opacity: 0.6
+                            };
+                        }
+                    });
+                }
+
+                function decode(base64, ArrayType) {
+                    var binary = atob(base64);
+                    var bytes = new Uint8Array(binary.length);
+                    for (var i = 0; i < binary.length; i++) {
+                        bytes[i] = binary.charCodeAt(i);
+                    }
+                    return new ArrayType(bytes.buffer);
+                }
+
+                // all points on one canvas, projected once to web
+                // mercator pixels at zoom 0 and scaled on redraw,
+                // aggregated cells grow with their count and show
+                // their statistics on a click
+                var PointCanvas = L.Layer.extend({
+                    initialize: function(points) {
+                        this._latitudes = decode(points.latitude, Float32Array);
+                        this._longitudes = decode(points.longitude, Float32Array);
+                        this._classes = decode(points.classes, Uint8Array);
+                        this._colors = points.colors;
+                        this._x = new Float64Array(points.count);
+                        this._y = new Float64Array(points.count);
+                        this._sizes = new Uint8Array(points.count).fill(4);
+                        for (var i = 0; i < points.count; i++) {
+                            var sin = Math.sin(this._latitudes[i] * Math.PI / 180);
+                            this._x[i] = 256 * (this._longitudes[i] + 180) / 360;
+                            this._y[i] = 256 * (0.5 - Math.log(
+                                (1 + sin) / (1 - sin)) / (4 * Math.PI));
+                        }
+                        this._cells = null;
+                        if (points.cell_count !== undefined) {
+                            this._cells = {
+                                mean: decode(points.mean, Float32Array),
+                                minimum: decode(points.minimum, Float32Array),
+                                maximum: decode(points.maximum, Float32Array),
+                                count: decode(points.cell_count, Uint32Array)
+                            };
+                            for (var j = 0; j < points.count; j++) {
+                                this._sizes[j] = 4 + Math.min(
+                                    8, Math.floor(Math.log2(this._cells.count[j])));
+                            }
+                        }
+                    },
+                    onAdd: function(map) {
+                        this._canvas = L.DomUtil.create('canvas');
+                        map.getPanes().overlayPane.appendChild(this._canvas);
+                        map.on('moveend zoomend resize', this._redraw, this);
+                        if (this._cells !== null) {
+                            map.on('click', this._showCell, this);
+                        }
+                        this._redraw();
+                    },
+                    onRemove: function(map) {
+                        map.off('moveend zoomend resize', this._redraw, this);
+                        map.off('click', this._showCell, this);
+                        L.DomUtil.remove(this._canvas);
+                    },
+                    _showCell: function(event) {
+                        var scale = Math.pow(2, this._map.getZoom());
+                        var clicked = this._map.project(event.latlng);
+                        var nearest = -1;
+                        var nearestDistance = Infinity;
+                        for (var i = 0; i < this._x.length; i++) {
+                            var dx = this._x[i] * scale - clicked.x;
+                            var dy = this._y[i] * scale - clicked.y;
+                            var distance = dx * dx + dy * dy;
+                            var reach = this._sizes[i] / 2 + 2;
+                            if (distance <= reach * reach
+                                    && distance < nearestDistance) {
+                                nearest = i;
+                                nearestDistance = distance;
+                            }
+                        }
+                        if (nearest < 0) {
+                            return;
+                        }
+                        var cells = this._cells;
+                        L.popup()
+                            .setLatLng([this._latitudes[nearest],
+                                        this._longitudes[nearest]])
+                            .setContent(
+                                cells.count[nearest] + ' measurements<br>'
+                                + 'mean ' + cells.mean[nearest].toFixed(2) + '<br>'
+                                + 'min ' + cells.minimum[nearest].toFixed(2) + '<br>'
+                                + 'max ' + cells.maximum[nearest].toFixed(2))
+                            .openOn(this._map);
+                    },
+                    _redraw: function() {
+                        var map = this._map;
+                        var size = map.getSize();
+                        var topLeft = map.containerPointToLayerPoint([0, 0]);
+                        var origin = topLeft.add(map.getPixelOrigin());
+                        var scale = Math.pow(2, map.getZoom());
+                        var canvas = this._canvas;
+                        canvas.width = size.x;
+                        canvas.height = size.y;
+                        L.DomUtil.setPosition(canvas, topLeft);
+
+                        var context = canvas.getContext('2d');
+                        for (var c = 0; c < this._colors.length; c++) {
+                            context.fillStyle = this._colors[c];
+                            for (var i = 0; i < this._classes.length; i++) {
+                                if (this._classes[i] !== c) {
+                                    continue;
+                                }
+                                var x = this._x[i] * scale - origin.x;
+                                var y = this._y[i] * scale - origin.y;
+                                var side = this._sizes[i];
+                                var half = side / 2;
+                                if (x >= -half && y >= -half
+                                        && x <= size.x + half
+                                        && y <= size.y + half) {
+                                    context.fillRect(x - half, y - half, side, side);
+                                }
+                            }
+                        }
+                    }
+                });
+
+                function pointLayerOf(points) {
+                    return new PointCanvas(points);
+                }
+
+                function showLegend(legendData) {
+                    var div = legend._div;
+                    if (legendData === null) {
+                        div.style.display = 'none';
+                        return;
+                    }
+                    var html = '<b>' + legendData.caption + '</b><br>';
+                    for (var i = legendData.colors.length - 1; i >= 0; i--) {
+                        html += '<i style="background:'
+                            + legendData.colors[i] + '"></i>'
+                            + legendData.levels[i].toFixed(1) + ' &ndash; '
+                            + legendData.levels[i + 1].toFixed(1) + '<br>';
+                    }
+                    div.innerHTML = html;
+                    div.style.display = 'block';
+                }
+
+                // tell the application the zoom level, it aggregates
+                // the points per screen cell when there are too many
+                if (typeof qt !== 'undefined' && typeof QWebChannel !== 'undefined') {
+                    new QWebChannel(qt.webChannelTransport, function(channel) {
+                        var bridge = channel.objects.bridge;
+                        map.on('zoomend', function() {
+                            bridge.viewChanged(map.getZoom());
+                        });
+                        bridge.viewChanged(map.getZoom());
+                    });
+                }
+
+                window.conceptva = {
+                    update: function(payload) {
+                        contourLayer = replaceLayer(
+                            contourLayer,
+                            payload.contours === null
+                                ? null : contourLayerOf(payload.contours)
+                        );
+                        pointLayer = replaceLayer(
+                            pointLayer,
+                            payload.points === null
+                                ? null : pointLayerOf(payload.points)
+                        );
+                        showLegend(payload.legend);
+                        return true;
+                    }
+                };
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self):
+        super().__init__()
+        self._name = "LayerBridge"
+
+
+def map_page_html(location: list, zoom_start: int = 10):
+    """ the html of the map page, loaded once into the web view """
+    fol_map = folium.Map(location=location, zoom_start=zoom_start)
+    fol_map.add_child(LayerBridge())
+    return fol_map.get_root().render()
+
+
+def standalone_map_html(location: list, layers: dict, zoom_start: int = 8):
+    """ a map page showing the given layers without the application,
+    as written by the batch renderer """
+    fol_map = folium.Map(location=location, zoom_start=zoom_start)
+    fol_map.add_child(LayerBridge())
+    html, end = fol_map.get_root().render().rsplit("</html>", 1)
+    # folium puts the scripts of the map after the body
+    return f"{html}<script>{update_script(**layers)}</script>\n</html>{end}"
+
+
+def update_script(
+    contours: str = None, points: str = None, legend: dict = None
+):
+    """
+    the JavaScript call replacing the layers of the page,
+    contours (GeoJSON) and points (see mapcreator.points_payload)
+    are JSON texts and are embedded as they are
+    """
+    return (
+        "conceptva.update({"
+        f'"contours": {contours or "null"}, '
+        f'"points": {points or "null"}, '
+        f'"legend": {json.dumps(legend)}'
+        "});"
+    )
+
+
+def legend_data(levels: list, colors: list, caption: str = "Salinity in PSU"):
+    """ the legend shown next to the layers """
+    return {
+        "levels": [float(level) for level in levels],
+        "colors": colors,
+        "caption": caption,
+    }
@@ -0,0 +1,147 @@
+"""
+Generator for synthetic OBS/BW/FW data,
+used to benchmark the pipeline without the real database
+"""
+import argparse
+import os
+import time
+
+import numpy
+import pandas as pd
+import xarray as xr
+
+from data_access import COLUMNAR_FORMATS
+from database_builder import (
+    SENSOR_COLUMNS,
+    EXTRAPOLATED_TABLES,
+    OBS_FILE_NAME,
+    create_writer,
+    file_name_to_time,
+    june_2013_file_names,
+    process_extrapolated_data
+)
+
+# rows of the 1x scale, about the 200 MB of june 2013 in data_test.db:
+# the stations of OBS and the rows of BW and FW per hourly file
+SCALE_OBS_ROWS = 500
+SCALE_EXT_ROWS = 1400
+SCALES = [1, 10, 100]
+
+
+def create_synthetic_frames(n_obs: int, n_ext: int, seed: int = 0):
+    """ build an OBS and an extrapolated frame with matching labels """
+    rng = numpy.random.default_rng(seed)
+    labels = numpy.array([f"station_{i:06d}".encode() for i in range(n_obs)])
+    df_obs = pd.DataFrame({
+        'label': labels,
+        'latitude': rng.uniform(53.0, 56.0, n_obs),
+        'longitude': rng.uniform(6.0, 10.0, n_obs),
+    })
+    for sensor_name in SENSOR_COLUMNS:
+        df_obs[sensor_name] = rng.uniform(0.0, 35.0, n_obs)
+
+    df_ext = pd.DataFrame({
+        'label': rng.choice(labels, n_ext),
+        'latitude': rng.uniform(53.0, 56.0, n_ext),
+        'longitude': rng.uniform(6.0, 10.0, n_ext),
+    })
+    return df_obs, df_ext
+
+
+def write_netcdf_fixtures(
+    directory: str, n_files: int = 24, n_obs: int = 500,
+    n_ext: int = 2000, seed: int = 0
+):
+    """
+    write an OBS file and n_files hourly BW/FW files in the layout
+    read by database_builder.LocalDirectorySource
+    """
+    df_obs, df_ext = create_synthetic_frames(n_obs, n_ext, seed)
+    df_obs['time'] = numpy.full(n_obs, b"201306010000")
+    df_obs.index.name = "obs"
+    df_ext.index.name = "points"
+
+    os.makedirs(directory, exist_ok=True)
+    xr.Dataset.from_dataframe(df_obs).to_netcdf(
+        os.path.join(directory, OBS_FILE_NAME)
+    )
+    dataset_ext = xr.Dataset.from_dataframe(df_ext)
+    for table_name in EXTRAPOLATED_TABLES:
+        os.makedirs(os.path.join(directory, table_name), exist_ok=True)
+        for file_name in june_2013_file_names()[:n_files]:
+            dataset_ext.to_netcdf(
+                os.path.join(directory, table_name, file_name)
+            )
+
+
+def write_synthetic_dataset(
+    writer, n_days: int = 7, n_obs: int = 500, n_ext: int = 2000,
+    seed: int = 0
+):
+    """
+    write OBS and hourly BW/FW data for the first n_days of june 2013
+    through one of the database_builder writers
+    """
+    rng = numpy.random.default_rng(seed)
+    df_obs, df_ext = create_synthetic_frames(n_obs, n_ext, seed)
+    file_names = june_2013_file_names()[:n_days * 24]
+
+    hours = rng.choice(file_names, n_obs)
+    df_obs['time'] = [file_name_to_time(file_name) for file_name in hours]
+    writer.write(OBS_FILE_NAME, {"OBS": df_obs})
+    process_extrapolated_data(df_ext, df_obs)
+
+    for file_name in file_names:
+        df_ext['initial_time'] = file_name_to_time(file_name)
+        writer.write(
+            file_name,
+            {table_name: df_ext for table_name in EXTRAPOLATED_TABLES}
+        )
+    writer.close()
+
+
+def write_scaled_dataset(writer, scale: float = 1, n_days: int = 30,
+                         seed: int = 0):
+    """ the synthetic dataset at a multiple of the size of june 2013 """
+    write_synthetic_dataset(
+        writer, n_days=n_days,
+        n_obs=int(SCALE_OBS_ROWS * scale),
+        n_ext=int(SCALE_EXT_ROWS * scale),
+        seed=seed
+    )
+
+
+def parse_args():
+    """ command line options of the generator """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--database", default="data/synthetic.db",
+        help="SQLite database to write, or the output directory "
+             "for the columnar formats"
+    )
+    parser.add_argument(
+        "--format", default="sqlite", choices=["sqlite", *COLUMNAR_FORMATS],
+        help="storage backend, as for database_builder.py"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1,
+        help="size relative to june 2013, e.g. 1, 10 or 100"
+    )
+    parser.add_argument(
+        "--days", type=int, default=30, help="days from june 1st, up to 30"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the random generator"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print("started generating...")
+    start_time = time.time()
+    write_scaled_dataset(
+        create_writer(args.database, args.format),
+        args.scale, args.days, args.seed
+    )
+    print("generating done in " + str(time.time() - start_time) + " seconds")
@@ -0,0 +1,331 @@
+"""
+Aggregation of the salinity per grid cell over sliding time windows,
+built from per-hour partial aggregates so moving the window only
+touches the hours entering and leaving it
+"""
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy
+import pandas as pd
+
+from data_access import DataStore, TIME_COLUMNS, shift_key
+
+# "raw" shows the measurements themselves, the others one value per cell
+AGGREGATIONS = ["raw", "mean", "min", "max", "latest"]
+# window lengths offered in the UI, in hours
+WINDOW_HOURS = {"1 hour": 1, "6 hours": 6, "1 day": 24, "1 week": 168}
+# the German Bight, longitude and latitude range of the aggregation grid
+AGGREGATION_BOUNDS = (6.0, 10.0, 53.0, 56.0)
+AGGREGATION_CELL_DEGREES = 0.025
+
+
+@dataclass
+class AggregationGrid:
+    """ fixed cells the partial aggregates of every hour share """
+    x_start: float
+    y_start: float
+    cell_degrees: float
+    columns: int
+    rows: int
+
+    @classmethod
+    def from_bounds(cls, bounds: tuple = AGGREGATION_BOUNDS,
+                    cell_degrees: float = AGGREGATION_CELL_DEGREES):
+        """ the grid covering (x_min, x_max, y_min, y_max) """
+        x_min, x_max, y_min, y_max = bounds
+        return cls(
+            x_min, y_min, cell_degrees,
+            int(numpy.ceil((x_max - x_min) / cell_degrees)),
+            int(numpy.ceil((y_max - y_min) / cell_degrees))
+        )
+
+    @property
+    def cells(self):
+        """ number of cells """
+        return self.columns * self.rows
+
+    def cell_index(self, longitude: numpy.ndarray, latitude: numpy.ndarray):
+        """ flat index of the cell of every position, -1 outside """
+        column = numpy.floor((longitude - self.x_start) / self.cell_degrees)
+        row = numpy.floor((latitude - self.y_start) / self.cell_degrees)
+        inside = (column >= 0) & (column < self.columns) \
+            & (row >= 0) & (row < self.rows)
+        return numpy.where(
+            inside, row * self.columns + column, -1
+        ).astype(numpy.int64)
+
+    def centers(self):
+        """ longitude and latitude of the center of every cell """
+        column = numpy.arange(self.cells) % self.columns
+        row = numpy.arange(self.cells) // self.columns
+        return (
+            self.x_start + (column + 0.5) * self.cell_degrees,
+            self.y_start + (row + 0.5) * self.cell_degrees
+        )
+
+
+@dataclass
+class PartialAggregate:
+    """ count, sum, min, max and the latest value per cell,
+    float32 keeps a week of hours in memory """
+    count: numpy.ndarray
+    total: numpy.ndarray
+    minimum: numpy.ndarray
+    maximum: numpy.ndarray
+    latest: numpy.ndarray
+    latest_time: numpy.ndarray
+
+
+def empty_aggregate(cells: int):
+    """ the neutral element of combine """
+    return PartialAggregate(
+        numpy.zeros(cells, dtype=numpy.int32),
+        numpy.zeros(cells, dtype=numpy.float32),
+        numpy.full(cells, numpy.nan, dtype=numpy.float32),
+        numpy.full(cells, numpy.nan, dtype=numpy.float32),
+        numpy.full(cells, numpy.nan, dtype=numpy.float32),
+        numpy.zeros(cells, dtype=numpy.int64),
+    )
+
+
+def combine(earlier: PartialAggregate, later: PartialAggregate):
+    """ the aggregate of both, associative so any grouping of the
+    hours gives the same result """
+    newer = later.latest_time >= earlier.latest_time
+    newer &= later.count > 0
+    return PartialAggregate(
+        earlier.count + later.count,
+        earlier.total + later.total,
+        numpy.fmin(earlier.minimum, later.minimum),
+        numpy.fmax(earlier.maximum, later.maximum),
+        numpy.where(newer, later.latest, earlier.latest),
+        numpy.where(newer, later.latest_time, earlier.latest_time),
+    )
+
+
+def hour_aggregate(
+    grid: AggregationGrid, longitude: numpy.ndarray,
+    latitude: numpy.ndarray, salinity: numpy.ndarray, time: numpy.ndarray
+):
+    """ the partial aggregate of the measurements of one hour """
+    aggregate = empty_aggregate(grid.cells)
+    cell = grid.cell_index(longitude, latitude)
+    valid = (cell >= 0) & ~numpy.isnan(salinity)
+    cell, salinity, time = cell[valid], salinity[valid], time[valid]
+    if len(cell) == 0:
+        return aggregate
+
+    aggregate.count += numpy.bincount(
+        cell, minlength=grid.cells
+    ).astype(numpy.int32)
+    aggregate.total += numpy.bincount(
+        cell, weights=salinity, minlength=grid.cells
+    ).astype(numpy.float32)
+
+    # sorted by cell and time every cell is a run ending with its latest
+    order = numpy.lexsort((time, cell))
+    cell, salinity, time = cell[order], salinity[order], time[order]
+    starts = numpy.flatnonzero(numpy.r_[True, cell[1:] != cell[:-1]])
+    ends = numpy.r_[starts[1:], len(cell)] - 1
+    occupied = cell[starts]
+    aggregate.minimum[occupied] = numpy.minimum.reduceat(salinity, starts)
+    aggregate.maximum[occupied] = numpy.maximum.reduceat(salinity, starts)
+    aggregate.latest[occupied] = salinity[ends]
+    aggregate.latest_time[occupied] = time[ends]
+    return aggregate
+
+
+class SlidingAggregate:
+    """
+    aggregate of a queue of hours with two stacks: new hours are
+    combined into the back, the front holds the aggregates from every
+    hour to the end of the front, when it runs empty the back is turned
+    over, so each hour is combined a constant number of times
+    """
+
+    def __init__(self, cells: int):
+        self.cells = cells
+        self.front = list()
+        self.back = list()
+        self.back_aggregate = empty_aggregate(cells)
+
+    def __len__(self):
+        return len(self.front) + len(self.back)
+
+    def push(self, aggregate: PartialAggregate):
+        """ add the next hour """
+        self.back.append(aggregate)
+        self.back_aggregate = combine(self.back_aggregate, aggregate)
+
+    def pop(self):
+        """ remove the oldest hour """
+        if not self.front:
+            suffix = empty_aggregate(self.cells)
+            while self.back:
+                suffix = combine(self.back.pop(), suffix)
+                self.front.append(suffix)
+            self.back_aggregate = empty_aggregate(self.cells)
+        self.front.pop()
+
+    def value(self):
+        """ the aggregate of all hours in the queue """
+        if not self.front:
+            return self.back_aggregate
+        return combine(self.front[-1], self.back_aggregate)
+
+
+def hour_key(time_key: int):
+    """ the full hour of a time key """
+    return time_key // 100 * 100
+
+
+def last_minute(hour: int):
+    """ the last key of the hour, keys have no seconds """
+    return hour + 59
+
+
+class WindowAggregator:
+    """
+    per cell aggregates of the window of the last request, moving it
+    forward by a few hours only reads and combines those hours,
+    other moves rebuild it from the cached partials of the hours;
+    like DataStore.get_window the window includes both keys
+    """
+
+    def __init__(self, data_store: DataStore, grid: AggregationGrid = None,
+                 cached_hours: int = 512):
+        self.data_store = data_store
+        self.grid = grid or AggregationGrid.from_bounds()
+        self.cached_hours = cached_hours
+        self.partials = OrderedDict()
+        self.window = SlidingAggregate(self.grid.cells)
+        self.window_hours = list()
+        self.lock = threading.Lock()
+
+    def hour_range(self, start_key: int, end_key: int):
+        """ the (first, last) key ranges of the full hours
+        inside [start_key, end_key] """
+        hours = list()
+        hour = hour_key(start_key)
+        if hour < start_key:
+            hour = shift_key(hour, hours=1)
+        while last_minute(hour) <= end_key:
+            hours.append((hour, last_minute(hour)))
+            hour = shift_key(hour, hours=1)
+        return hours
+
+    def edge_ranges(self, start_key: int, end_key: int, hours: list):
+        """ the key ranges of [start_key, end_key] before and after the
+        full hours, e.g. the minute end_key of a window of whole hours """
+        if not hours:
+            return [(start_key, end_key)] if start_key <= end_key else []
+        edges = list()
+        if start_key < hours[0][0]:
+            edges.append((
+                start_key, last_minute(shift_key(hours[0][0], hours=-1))
+            ))
+        after = shift_key(hours[-1][0], hours=1)
+        if after <= end_key:
+            edges.append((after, end_key))
+        return edges
+
+    def read_ranges(self, key_ranges: list):
+        """ partial aggregates of the key ranges, the ones not cached are
+        read with a single query and split by range """
+        missing = [
+            key_range for key_range in key_ranges
+            if key_range not in self.partials
+        ]
+        if missing:
+            m_data = self.data_store.get_window(
+                min(first for first, _ in missing),
+                max(last for _, last in missing)
+            )
+            frames = list()
+            for df, table_name in (
+                (m_data.data_obs, "OBS"),
+                (m_data.data_bw, "BW"),
+                (m_data.data_fw, "FW")
+            ):
+                frames.append(pd.DataFrame({
+                    'longitude': df['longitude'].to_numpy(dtype=float),
+                    'latitude': df['latitude'].to_numpy(dtype=float),
+                    'sensor_1': df['sensor_1'].to_numpy(dtype=float),
+                    'time': df[TIME_COLUMNS[table_name]].to_numpy(
+                        dtype=numpy.int64
+                    ),
+                }))
+            rows = pd.concat(frames).sort_values('time', kind='stable')
+            times = rows['time'].to_numpy()
+            for first, last in missing:
+                df = rows.iloc[
+                    times.searchsorted(first, side='left'):
+                    times.searchsorted(last, side='right')
+                ]
+                self.partials[(first, last)] = hour_aggregate(
+                    self.grid,
+                    df['longitude'].to_numpy(),
+                    df['latitude'].to_numpy(),
+                    df['sensor_1'].to_numpy(),
+                    df['time'].to_numpy()
+                )
+        partials = list()
+        for key_range in key_ranges:
+            self.partials.move_to_end(key_range)
+            partials.append(self.partials[key_range])
+        while len(self.partials) > max(self.cached_hours, len(key_ranges)):
+            self.partials.popitem(last=False)
+        return partials
+
+    def aggregate(self, start_key: int, end_key: int):
+        """ the partial aggregate of the window [start_key, end_key] """
+        hours = self.hour_range(start_key, end_key)
+        edges = self.edge_ranges(start_key, end_key, hours)
+        with self.lock:
+            overlap = 0
+            if self.window_hours and hours and \
+                    self.window_hours[0] <= hours[0] <= self.window_hours[-1]:
+                overlap = len(self.window_hours) \
+                    - self.window_hours.index(hours[0])
+                if self.window_hours[-overlap:] != hours[:overlap]:
+                    overlap = 0
+
+            if overlap == 0:
+                self.window = SlidingAggregate(self.grid.cells)
+                self.window_hours = list()
+            # the hours leaving and entering the window
+            while len(self.window_hours) > overlap:
+                self.window.pop()
+                self.window_hours.pop(0)
+            entering = hours[len(self.window_hours):]
+            partials = self.read_ranges(entering + edges)
+            for partial in partials[:len(entering)]:
+                self.window.push(partial)
+            self.window_hours += entering
+            # the partial hours at the edges are not part of the slide
+            value = self.window.value()
+            for partial in partials[len(entering):]:
+                value = combine(value, partial)
+            return value
+
+    def frame(self, start_key: int, end_key: int, aggregation: str):
+        """ latitude, longitude and sensor_1 of every cell with data,
+        the value is the aggregation over the window """
+        aggregate = self.aggregate(start_key, end_key)
+        occupied = aggregate.count > 0
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            values = {
+                'mean': aggregate.total / aggregate.count,
+                'min': aggregate.minimum,
+                'max': aggregate.maximum,
+                'latest': aggregate.latest,
+            }[aggregation]
+        longitude, latitude = self.grid.centers()
+        return pd.DataFrame({
+            'latitude': latitude[occupied],
+            'longitude': longitude[occupied],
+            'sensor_1': values[occupied].astype(float),
+        })
+
@@ -0,0 +1,46 @@
+"""
+The process pool of the batch jobs: every worker sets up its state
+once and only a few tasks are in flight at a time
+"""
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# tasks submitted per worker, bounds the results waiting in memory
+TASKS_PER_WORKER = 2
+
+# state of the worker process, set by init_worker
+_worker_state = dict()
+
+
+def init_worker(setup, *setup_args):
+    """ runs setup(*setup_args) once in every worker process """
+    global _worker_state
+    _worker_state = setup(*setup_args)
+
+
+def worker_state():
+    """ the dict setup returned in this worker process """
+    return _worker_state
+
+
+def bounded_map(function, tasks: list, setup, setup_args: tuple = (),
+                workers: int = None):
+    """
+    the results of function(*task) for the tasks in the order they
+    finish, the tasks are submitted in order and only a few at a time
+    since the decoded files and windows are large
+    """
+    workers = workers or os.cpu_count()
+    pending = list(reversed(tasks))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=init_worker,
+        initargs=(setup, *setup_args)
+    ) as executor:
+        in_flight = set()
+        while pending or in_flight:
+            while pending and len(in_flight) < TASKS_PER_WORKER * workers:
+                in_flight.add(executor.submit(function, *pending.pop()))
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()